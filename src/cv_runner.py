@@ -0,0 +1,205 @@
+# runs every fold of a cross validation split made by r_partition2.py through
+# tf_main at the same time on one node. each fold gets its own output folder,
+# a set of cores it's pinned to and thread limits to match, then is tested on
+# its held out part. the last line of every fold's training.log and
+# testing.log goes into cv_summary.csv, with the mean and standard deviation.
+#
+# arguments this script doesn't know are passed on to tf_main:
+# python cv_runner.py --prefix ../data/gdc_rh5 --output ../cv \
+#     --graph_type CenterLossAutoencoder --epoch_count 20 --batch_size 1000
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import csv
+import multiprocessing
+import os
+import subprocess
+import sys
+import timeit
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+def parseArgs():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prefix', required=True, action='store', help='--outname given to r_partition2.py, the folds are <prefix>.train.fea.N, <prefix>.train.lab.N, <prefix>.test.fea.N and <prefix>.test.lab.N')
+    parser.add_argument('--folds', default=0, type=int, action='store', help='number of folds. 0 counts the <prefix>.train.fea.N files')
+    parser.add_argument('--output', required=True, action='store', help='folder for the fold<N> output folders and cv_summary.csv')
+    parser.add_argument('--parallel', default=0, type=int, action='store', help='folds running at the same time. 0 runs them all when there are enough cores')
+    parser.add_argument('--cores_per_fold', default=0, type=int, action='store', help='cores each fold is pinned to and threads it may use. 0 splits the cores evenly')
+    parser.add_argument('--no_test', action='store_true', default=False, help="don't run the trained folds on their test part")
+    args, tf_main_args = parser.parse_known_args()
+
+    return args, tf_main_args
+
+def countFolds(prefix):
+    folds = 0
+    while os.path.exists('%s.train.fea.%d' % (prefix, folds)):
+        folds += 1
+    return folds
+
+def availableCores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+# (folds running at once, cores of each) for the cores there are
+def planCores(args, folds, cores):
+    parallel = args.parallel
+    if parallel <= 0:
+        if args.cores_per_fold > 0:
+            parallel = max(len(cores) // args.cores_per_fold, 1)
+        else:
+            parallel = len(cores)
+    parallel = max(min(parallel, folds), 1)
+
+    per_fold = args.cores_per_fold
+    if per_fold <= 0:
+        per_fold = max(len(cores) // parallel, 1)
+
+    # slots past the cores there are wrap around and share them
+    core_sets = []
+    for slot in range(parallel):
+        core_sets.append([cores[(slot*per_fold + c) % len(cores)] for c in range(per_fold)])
+    return core_sets
+
+# the tf_main command lines of a fold: training on its train part with the
+# test part as validation, then testing, which writes testing.log
+def foldCommands(args, tf_main_args, fold, fold_dir):
+    tf_main = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tf_main.py')
+    test_data = ['--valid', '%s.test.fea.%d' % (args.prefix, fold),
+        '--validy', '%s.test.lab.%d' % (args.prefix, fold),
+        '--outputFolder', fold_dir, '--summaryFolder', fold_dir]
+
+    commands = [[sys.executable, tf_main,
+        '--trainx', '%s.train.fea.%d' % (args.prefix, fold),
+        '--trainy', '%s.train.lab.%d' % (args.prefix, fold)] + test_data + tf_main_args]
+    if not args.no_test:
+        commands.append([sys.executable, tf_main] + test_data + tf_main_args)
+    return commands
+
+# runs command on cores with as many threads. the folds are started from
+# threads, where a preexec_fn isn't safe, so taskset does the pinning
+def runPinned(command, cores, output):
+    env = dict(os.environ)
+    for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        env[name] = str(len(cores))
+
+    command = ['taskset', '-c', ','.join(map(str, cores))] + command
+
+    # the session thread pools follow the cores unless they were given
+    if '--intra_op_threads' not in command:
+        command = command + ['--intra_op_threads', str(len(cores))]
+    if '--inter_op_threads' not in command:
+        command = command + ['--inter_op_threads', '1']
+
+    with open(output, 'a') as out:
+        out.write(' '.join(command) + '\n')
+        out.flush()
+        return subprocess.call(command, stdout=out, stderr=subprocess.STDOUT, env=env)
+
+def runFold(args, tf_main_args, fold, free_cores):
+    fold_dir = os.path.join(args.output, 'fold%d' % fold)
+    if not os.path.exists(fold_dir):
+        os.makedirs(fold_dir)
+
+    cores = free_cores.get()
+    try:
+        start = timeit.default_timer()
+        print("fold", fold, "on cores", cores)
+        for command in foldCommands(args, tf_main_args, fold, fold_dir):
+            returncode = runPinned(command, cores, os.path.join(fold_dir, 'cv_runner.out'))
+            if returncode != 0:
+                break
+        seconds = timeit.default_timer() - start
+        print("fold", fold, "finished with", returncode, "after %.0f s" % seconds)
+    finally:
+        free_cores.put(cores)
+
+    return {'fold':fold, 'returncode':returncode, 'seconds':seconds}
+
+# (column, value) of the last row of a log written by tf_log, in the order of
+# its header. empty when there's none
+def lastLogRow(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        rows = list(csv.reader(f))
+    if len(rows) < 2:
+        return []
+    return list(zip(rows[0], rows[-1]))
+
+def writeSummary(args, results):
+    rows = []
+    columns = ['fold', 'returncode', 'seconds']
+    for result in results:
+        fold_dir = os.path.join(args.output, 'fold%d' % result['fold'])
+        row = dict(result)
+        for name in ['training', 'testing']:
+            for key, value in lastLogRow(os.path.join(fold_dir, name + '.log')):
+                column = name + ':' + key
+                if column not in columns:
+                    columns.append(column)
+                row[column] = value
+        rows.append(row)
+
+    # mean and standard deviation of every numeric column, over the folds
+    # that have it
+    def numbers(column):
+        values = []
+        for row in rows:
+            if row.get(column, '') == '':
+                continue
+            try:
+                values.append(float(row[column]))
+            except ValueError:
+                return []
+        return values
+
+    mean = {'fold':'mean'}
+    std = {'fold':'std'}
+    for column in columns[2:]:
+        values = numbers(column)
+        if values:
+            mean[column] = np.mean(values)
+            std[column] = np.std(values)
+
+    summary_path = os.path.join(args.output, 'cv_summary.csv')
+    with open(summary_path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows + [mean, std]:
+            writer.writerow([row.get(column, '') for column in columns])
+
+    return summary_path
+
+if __name__ == "__main__":
+    args, tf_main_args = parseArgs()
+
+    folds = args.folds if args.folds > 0 else countFolds(args.prefix)
+    if folds == 0:
+        raise ValueError("no folds found for %s" % args.prefix)
+
+    core_sets = planCores(args, folds, availableCores())
+    free_cores = queue.Queue()
+    for cores in core_sets:
+        free_cores.put(cores)
+
+    # threads only wait on the tf_main processes
+    pool = ThreadPool(len(core_sets))
+    results = pool.map(lambda fold: runFold(args, tf_main_args, fold, free_cores), range(folds))
+    pool.close()
+
+    summary_path = writeSummary(args, results)
+    print("summary in", summary_path)
+
+    failed = [r['fold'] for r in results if r['returncode'] != 0]
+    if failed:
+        print("failed folds", failed)
+        sys.exit(1)
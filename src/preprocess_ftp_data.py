@@ -7,6 +7,8 @@ import os
 import sklearn.preprocessing as skprep
 import sklearn.model_selection as skms
 
+from tf_container import write_container
+
 ##This step is included to create the default folder###
 
 main_dir='../data/processed_ftp_data'
@@ -36,6 +38,16 @@ def parse_args():
             default='../data/processed_ftp_data/',
             help='output directory for processed data')
 
+    parser.add_argument('--container',
+            action='store_true',
+            help='also write each split as one rnaseq_features.<subset>.cgrp file \
+                holding the features, labels and sample names')
+
+    parser.add_argument('--chunk_rows',
+            type=int,
+            default=0,
+            help='rows per chunk in the containers. 0 writes one chunk per split')
+
     return parser.parse_args()
 
 class CombinedRNASeqData:
@@ -225,6 +237,18 @@ if __name__ == '__main__':
             for s in sample:
                 f.write(s+'\n')
 
+    # save the gene of every feature column, for --feature_header
+    with open(os.path.join(args.output_dir, 'rnaseq_features.genes'), 'w') as f:
+        for gene in crd.feat_cols:
+            f.write(gene+'\n')
+
+    # save single file containers
+    if args.container:
+        for X, y, sample, subset in zip(Xs, ys, samples, ['train', 'valid', 'test']):
+            filename = '.'.join(['rnaseq_features', subset, 'cgrp'])
+            write_container(os.path.join(args.output_dir, filename), [X], labels=y, 
+                keys=sample, label_kind='classes', chunk_rows=args.chunk_rows)
+
     # export label encoder mapping
     crd.export_label_encoder_mapping(
         os.path.join(args.output_dir, 'label_map_vy1.txt')
@@ -0,0 +1,188 @@
+# checkpoints written on a background thread. save() copies the variables
+# out of the training session and returns, a writer thread saves the copy
+# through a graph of its own while training goes on.
+#
+# every save goes to a new version, <prefix>-<n>, and only counts once
+# <prefix>.checkpoints, a small json file replaced by rename, lists it. a
+# crash while writing leaves the previous versions and the list untouched.
+# the list also drives retention: the last keep_last versions of a plain
+# checkpoint, or the keep_best versions with the lowest cost when a cost is
+# given, like the ratchet checkpoint. resolve() turns a prefix into the
+# version to restore.
+from __future__ import division, print_function, absolute_import
+
+import os
+import glob
+import json
+import threading
+
+import tensorflow as tf
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+def state_path(prefix):
+    return prefix + '.checkpoints'
+
+# {'current': version to restore, 'entries': [{'name', 'step', 'cost'}]}.
+# names are relative to the directory of prefix
+def read_state(prefix):
+    path = state_path(prefix)
+    if not os.path.exists(path):
+        return {'current':None, 'entries':[]}
+    with open(path) as f:
+        return json.load(f)
+
+def write_state(prefix, state):
+    tmp_path = state_path(prefix) + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, state_path(prefix))
+
+def remove_version(path):
+    for name in [path + '.index', path + '.meta'] + glob.glob(path + '.data-*'):
+        if os.path.exists(name):
+            os.remove(name)
+
+# the checkpoint to restore for prefix: the current version of the
+# CheckpointWriter or prefix itself, as Saver.save writes it, whichever is
+# newer. None when neither exists
+def resolve(prefix):
+    candidates = []
+    if os.path.exists(prefix + '.index'):
+        candidates.append(prefix)
+
+    current = read_state(prefix)['current']
+    if current is not None:
+        path = os.path.join(os.path.dirname(prefix), current)
+        if os.path.exists(path + '.index'):
+            candidates.append(path)
+
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=lambda path: os.path.getmtime(path + '.index'))
+
+class CheckpointWriter(object):
+    # sess: the training session, variables: what to save, the same list as
+    #   Network's saver
+    # keep_last: versions kept of checkpoints saved without a cost
+    # keep_best: versions kept of checkpoints saved with a cost, lowest first
+    def __init__(self, sess, variables, keep_last=1, keep_best=1):
+        if keep_last < 1 or keep_best < 1:
+            raise ValueError("a checkpoint writer has to keep at least one version")
+        self.sess = sess
+        self.variables = variables
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+
+        # a copy of every variable, initialized from the snapshot. it lives
+        # on the cpu so it doesn't compete with training for gpu memory
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders = []
+            copies = {}
+            for v in variables:
+                placeholder = tf.placeholder(v.dtype.base_dtype, v.shape)
+                self.placeholders.append(placeholder)
+                with tf.device('/cpu:0'):
+                    copies[v.op.name] = tf.Variable(placeholder, trainable=False)
+            self.assign = tf.variables_initializer(list(copies.values()))
+            self.saver = tf.train.Saver(copies, max_to_keep=None)
+        self.copy_sess = tf.Session(graph=self.graph,
+            config=tf.ConfigProto(device_count={'GPU':0}))
+
+        # the state of every prefix as of the queued saves. the writer thread
+        # commits them in order
+        self.states = {}
+
+        # one save waiting behind the one being written, so at most two
+        # snapshots are held
+        self.jobs = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def state(self, prefix):
+        if prefix not in self.states:
+            self.states[prefix] = read_state(prefix)
+        return self.states[prefix]
+
+    # whether a checkpoint with this cost would be kept under keep_best
+    def is_kept(self, prefix, cost):
+        costs = [e['cost'] for e in self.state(prefix)['entries']]
+        return len(costs) < self.keep_best or cost < max(costs)
+
+    # snapshots the variables and queues them to be saved as the next version
+    # of prefix. with a cost the version is ranked against the others by it
+    # and nothing is saved when it wouldn't be kept. after runs on the writer
+    # thread once the version is committed. returns whether it was queued
+    def save(self, prefix, cost=None, after=None):
+        self.check()
+        if cost is not None and not self.is_kept(prefix, cost):
+            return False
+
+        old = self.state(prefix)
+        step = max([e['step'] for e in old['entries']] + [0]) + 1
+        name = '%s-%d' % (os.path.basename(prefix), step)
+
+        entries = old['entries'] + [{'name':name, 'step':step, 'cost':cost}]
+        if cost is None:
+            entries = entries[-self.keep_last:]
+            current = name
+        else:
+            entries = sorted(entries, key=lambda e: e['cost'])[:self.keep_best]
+            current = entries[0]['name']
+        state = {'current':current, 'entries':entries}
+        self.states[prefix] = state
+
+        values = self.sess.run(self.variables)
+        self.jobs.put((prefix, name, values, old, state, after))
+        return True
+
+    def write(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+
+            prefix, name, values, old, state, after = job
+            try:
+                self.copy_sess.run(self.assign, dict(zip(self.placeholders, values)))
+                del values
+                directory = os.path.dirname(prefix)
+                self.saver.save(self.copy_sess, os.path.join(directory, name),
+                    write_meta_graph=False, write_state=False)
+                write_state(prefix, state)
+
+                # dropped versions only go once the new list is in place
+                kept = set(e['name'] for e in state['entries'])
+                for e in old['entries']:
+                    if e['name'] not in kept:
+                        remove_version(os.path.join(directory, e['name']))
+
+                if after is not None:
+                    after()
+            except Exception as e:
+                self.error = e
+            self.jobs.task_done()
+
+    # raises an error of the writer thread on the training thread
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    # blocks until every queued save is written
+    def wait(self):
+        self.jobs.join()
+        self.check()
+
+    def stop(self):
+        self.jobs.put(None)
+        self.thread.join()
+        self.copy_sess.close()
+        self.check()
@@ -0,0 +1,154 @@
+# single file container for a whole split: every feature set, the labels and
+# the sample keys, cut into chunks that ChunkGroup reads lazily.
+#
+# layout:
+#   8 bytes   magic, CGRP0001
+#   8 bytes   little endian uint64, length of the json header
+#   header    json with num_rows, the row offset of every chunk and one entry
+#             per array with its name, role, dtype, shape and byte offset
+#   arrays    row major, each one starting on a 64 byte boundary
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+import json
+import os
+import struct
+
+MAGIC = b'CGRP0001'
+ALIGN = 64
+
+def aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+class Container(object):
+    def __init__(self, path):
+        self.path = path
+
+        # one read only mapping of the whole file. every array is a view of it,
+        # so rows are read on demand and any row can be reached directly
+        self.raw = np.memmap(path, dtype=np.uint8, mode='r')
+        if self.raw[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError("%s is not a chunk container" % path)
+
+        header_length = struct.unpack('<Q', self.raw[8:16].tobytes())[0]
+        self.header = json.loads(self.raw[16:16+header_length].tobytes().decode('utf-8'))
+
+        self.num_rows = self.header['num_rows']
+        # chunk i holds rows offsets[i] up to offsets[i+1]
+        self.offsets = self.header['chunks']
+        self.num_chunks = len(self.offsets) - 1
+
+        self.arrays = {}
+        self.features = []
+        self.labels = None
+        self.keys = None
+        for entry in self.header['arrays']:
+            dtype = np.dtype(str(entry['dtype']))
+            shape = tuple(entry['shape'])
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            start = entry['offset']
+            self.arrays[entry['name']] = self.raw[start:start+nbytes].view(dtype).reshape(shape)
+
+            if entry['role'] == 'features':
+                self.features.append(entry['name'])
+            elif entry['role'] == 'labels':
+                self.labels = entry['name']
+            elif entry['role'] == 'keys':
+                self.keys = entry['name']
+
+    def chunk(self, name, index):
+        return self.arrays[name][self.offsets[index]:self.offsets[index+1]]
+
+    # random access to any rows of an array, by their row number in the split
+    def rows(self, name, index):
+        return self.arrays[name][index]
+
+    def chunk_paths(self, name):
+        return [ContainerChunk(self, name, i) for i in range(self.num_chunks)]
+
+    def feature_paths(self):
+        return [self.chunk_paths(name) for name in self.features]
+
+    def label_paths(self):
+        if self.labels is None:
+            return []
+        return self.chunk_paths(self.labels)
+
+    def sample_keys(self):
+        if self.keys is None:
+            return None
+        return self.arrays[self.keys]
+
+# one chunk of one array of a container. it is a str so it can stand in for a
+# chunk file name in ChunkGroup. the name ends in <array>.<chunk> and labels
+# are stored as labels.y or labels.r, so the file name checks that tell
+# class labels from regression labels keep working
+class ContainerChunk(str):
+    def __new__(cls, container, name, index):
+        self = str.__new__(cls, '%s#%s.%d' % (container.path, name, index))
+        self.container = container
+        self.name = name
+        self.index = index
+        # the file to stat when checking whether cached results are stale
+        self.source = container.path
+        return self
+
+    def load(self, mmap=False):
+        data = self.container.chunk(self.name, self.index)
+        if mmap:
+            return data
+        return np.array(data)
+
+# features: list of arrays, one per feature set, all with the same rows
+# labels: class labels (label_kind='classes') or regression targets
+#   (label_kind='regression'). keyed labels are a two column regression array
+# keys: optional sample keys. strings are stored as utf-8 bytes
+# chunk_rows: rows per chunk, 0 puts the whole split in one chunk
+def write_container(path, features, labels=None, keys=None, label_kind='classes', chunk_rows=0):
+    arrays = [('features%d' % i, 'features', np.asarray(f)) for i, f in enumerate(features)]
+    if labels is not None:
+        name = 'labels.y' if label_kind == 'classes' else 'labels.r'
+        arrays.append((name, 'labels', np.asarray(labels)))
+    if keys is not None:
+        keys = np.asarray(keys)
+        if keys.dtype.kind in 'OU':
+            keys = np.char.encode(keys.astype('U'), 'utf-8')
+        arrays.append(('keys', 'keys', keys))
+
+    num_rows = arrays[0][2].shape[0]
+    for name, role, a in arrays:
+        if a.shape[0] != num_rows:
+            raise ValueError("%s has %d rows, expected %d" % (name, a.shape[0], num_rows))
+
+    if chunk_rows > 0:
+        offsets = list(range(0, num_rows, chunk_rows)) + [num_rows]
+    else:
+        offsets = [0, num_rows]
+
+    # the array offsets depend on the header length and the header holds the
+    # offsets, so grow the space reserved for the header until it fits
+    data_start = aligned(16)
+    while True:
+        entries = []
+        offset = data_start
+        for name, role, a in arrays:
+            entries.append({'name':name, 'role':role, 'dtype':a.dtype.str,
+                'shape':list(a.shape), 'offset':offset})
+            offset = aligned(offset + a.nbytes)
+        header = json.dumps({'num_rows':num_rows, 'chunks':offsets, 'arrays':entries}).encode('utf-8')
+        if 16 + len(header) <= data_start:
+            break
+        data_start = aligned(16 + len(header))
+
+    # json allows trailing whitespace, pad the header up to the first array
+    header += b' ' * (data_start - 16 - len(header))
+
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for entry, (name, role, a) in zip(entries, arrays):
+            f.write(b'\0' * (entry['offset'] - f.tell()))
+            np.ascontiguousarray(a).tofile(f)
+    os.rename(tmp_path, path)
@@ -7,22 +7,277 @@ import math
 import os
 import timeit
 import argparse
+import threading
+import multiprocessing
+import traceback
+import json
 import pickle as pkl
 
-import sklearn.utils
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 
+from tf_container import Container, ContainerChunk
+
+# text chunks are parsed once and saved next to the source as <path>.cache.npy.
+# <path>.cache.key holds the size and mtime of the text file the cache was
+# built from, so editing or replacing the text file rebuilds the cache
+def load_chunk(path, mmap=False):
+    if isinstance(path, ContainerChunk):
+        return path.load(mmap=mmap)
+
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r' if mmap else None)
+
+    cache_path = path + '.cache.npy'
+    key_path = path + '.cache.key'
+    stat = os.stat(path)
+    key = '%d %r' % (stat.st_size, stat.st_mtime)
+    try:
+        with open(key_path) as f:
+            if f.read() == key:
+                return np.load(cache_path, mmap_mode='r' if mmap else None)
+    except (IOError, OSError, ValueError):
+        pass
+
+    data = np.loadtxt(path, dtype="float")
+
+    # write to temporary names and rename, so a reader never sees half a
+    # cache. the key goes last, it only matches once the data is in place
+    try:
+        suffix = '.%d.tmp' % os.getpid()
+        with open(cache_path + suffix, 'wb') as f:
+            np.save(f, data)
+        with open(key_path + suffix, 'w') as f:
+            f.write(key)
+        os.rename(cache_path + suffix, cache_path)
+        os.rename(key_path + suffix, key_path)
+    except (IOError, OSError):
+        # read only data folder. keep parsing the text every time
+        print("could not cache", path)
+
+    return data
+
+# summaries of chunk files that passed the finite check, one registry per
+# folder. a file is scanned once and skipped by later loads, in this process
+# and in later runs, until its size or mtime changes
+VALIDATION_REGISTRY = '.chunk_validation.json'
+validated_chunks = {}
+
+# rows scanned at a time, about 64 MB
+def scan_rows(data):
+    row_bytes = max(int(np.prod(data.shape[1:])) * data.dtype.itemsize, 1)
+    return max((64 * 2**20) // row_bytes, 1)
+
+# one pass over the rows in blocks, so a mapped file is read once and never
+# held in memory. returns the summary recorded in the registry
+def scan_chunk(path, data):
+    if data.dtype.kind not in 'fiub':
+        raise ValueError("%s has dtype %s, expected numbers" % (path, data.dtype))
+
+    max_abs = 0.
+    step = scan_rows(data)
+    for start in range(0, data.shape[0], step):
+        block = data[start:start+step]
+        if block.dtype.kind == 'f' and not np.isfinite(block).all():
+            raise ValueError("%s contains NaN or infinity" % path)
+        if block.size > 0:
+            max_abs = max(max_abs, float(np.abs(block).max()))
+
+    return {'shape':list(data.shape), 'dtype':data.dtype.str, 'max_abs':max_abs}
+
+def read_registry(registry_fn):
+    try:
+        with open(registry_fn) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+# checks a chunk as it comes out of load_chunk, before any cast or column
+# selection, unless the registry already holds a summary for this version of
+# the file. returns the summary
+def validate_chunk(path, data):
+    key = file_key(path)
+    name = str(path)
+    known = validated_chunks.get(name)
+    if key is not None and known is not None and known[0] == key:
+        return known[1]
+
+    registry_fn = os.path.join(os.path.dirname(getattr(path, 'source', path)), VALIDATION_REGISTRY)
+    entry_name = os.path.basename(name)
+    registry = read_registry(registry_fn)
+    entry = registry.get(entry_name)
+    if key is not None and entry is not None and entry['key'] == key and \
+            entry['summary']['shape'] == list(data.shape) and entry['summary']['dtype'] == data.dtype.str:
+        summary = entry['summary']
+    else:
+        summary = scan_chunk(name, data)
+        if key is not None:
+            # other processes may write the registry at the same time. the
+            # last rename wins and a lost entry is only scanned again
+            registry = read_registry(registry_fn)
+            registry[entry_name] = {'key':key, 'summary':summary}
+            try:
+                tmp_fn = registry_fn + '.%d.tmp' % os.getpid()
+                with open(tmp_fn, 'w') as f:
+                    json.dump(registry, f)
+                os.rename(tmp_fn, registry_fn)
+            except (IOError, OSError):
+                print("could not record the validation of", name)
+
+    if key is not None:
+        validated_chunks[name] = (key, summary)
+    return summary
+
+# the file whose size and mtime stand for path. chunks of a container are
+# checked through the container file
+def key_path(path):
+    return getattr(path, 'source', path)
+
+# (size, mtime) of a file, None if it is gone
+def file_key(path):
+    path = key_path(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+# sorted unique labels of a set of label files. the result is kept in a json
+# manifest with the size and mtime of every file it came from, and is only
+# reused for the same files while none of them changes. other paths are
+# scanned and replace the manifest
+def label_vocabulary(paths, manifest_fn=None):
+    if manifest_fn is not None and os.path.exists(manifest_fn):
+        with open(manifest_fn) as f:
+            manifest = json.load(f)
+        same_files = set(key_path(path) for path in paths) == set(path for path, key in manifest['files'])
+        if same_files and all(key is not None and file_key(path) == key for path, key in manifest['files']):
+            return np.array(manifest['classes'])
+
+    # one vectorized unique per file, only the label files are read
+    classes = np.unique(np.concatenate([np.unique(load_chunk(path)) for path in paths]))
+
+    if manifest_fn is not None:
+        # the manifest is read back as plain strings, so container chunks are
+        # recorded by their container file, once
+        files = []
+        for path in paths:
+            if key_path(path) not in files:
+                files.append(key_path(path))
+        manifest = {'files':[[path, file_key(path)] for path in files], 'classes':classes.tolist()}
+        tmp_fn = manifest_fn + '.%d.tmp' % os.getpid()
+        with open(tmp_fn, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp_fn, manifest_fn)
+
+    return classes
+
+# the iterator state saved next to a checkpoint. written to a temporary
+# file and renamed, a preempted save leaves the previous state in place
+def save_iterator_state(path, state):
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        pkl.dump(state, f, protocol=2)
+    os.rename(tmp_path, path)
+
+def load_iterator_state(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pkl.load(f)
+
+# turns materialized feature chunks, where every row repeats the vector of its
+# drug or cell line, into a lookup table of the unique rows (table_path, .npy)
+# and one chunk of row ids per input chunk (<chunk>.ids.npy), for LookupChunkData
+def split_lookup_table(paths, table_path):
+    chunks = [load_chunk(path) for path in paths]
+    sizes = [chunk.shape[0] for chunk in chunks]
+    table, ids = np.unique(np.concatenate(chunks), axis=0, return_inverse=True)
+    np.save(table_path, table)
+
+    id_paths = []
+    for path, chunk_ids in zip(paths, np.split(ids, np.cumsum(sizes)[:-1])):
+        id_paths.append(path + '.ids.npy')
+        np.save(id_paths[-1], chunk_ids.astype(np.int32))
+
+    print("%d rows, %d unique" % (sum(sizes), table.shape[0]))
+    return id_paths
+
+# the columns of a gene panel. columns_fn lists one column per line, either
+# as a column index or as a gene name. names are looked up in header_fn, which
+# holds the name of every column of the chunks, one per line. returns the
+# column indices in the order given and their names, if known
+def select_columns(columns_fn, header_fn=''):
+    with open(columns_fn) as f:
+        entries = [line.strip() for line in f if line.strip()]
+
+    header = None
+    if header_fn:
+        with open(header_fn) as f:
+            header = [line.strip() for line in f if line.strip()]
+
+    if all(e.isdigit() for e in entries):
+        columns = np.array([int(e) for e in entries])
+    else:
+        if header is None:
+            raise ValueError("%s lists gene names, a header file is needed to find them" % columns_fn)
+        position = dict((name, i) for i, name in enumerate(header))
+        missing = [e for e in entries if e not in position]
+        if len(missing) > 0:
+            raise ValueError("%d genes of %s are not in %s, like %s" % \
+                (len(missing), columns_fn, header_fn, ', '.join(missing[:5])))
+        columns = np.array([position[e] for e in entries])
+
+    names = None
+    if header is not None:
+        names = [header[c] for c in columns]
+
+    return columns, names
+
+# the column of the chunks behind every input column, so weights and
+# encodings can be traced back to genes
+def write_feature_columns(path, columns, names=None):
+    with open(path, 'w') as f:
+        for i, c in enumerate(columns):
+            if names is None:
+                f.write('%d\t%d\n' % (i, c))
+            else:
+                f.write('%d\t%d\t%s\n' % (i, c, names[i]))
+
 # one chunk
 class SingleChunk:
-    def __init__(self, path='', batch_size=32):
+    def __init__(self, path='', batch_size=32, mmap=False, dtype=None, columns=None):
         self.path = path
         self.batch_size = batch_size
-        if path.endswith('.npy'):
-            self.allData = np.load(self.path)
-        else:
-            self.allData = np.loadtxt(self.path, dtype="float")
-
-        sklearn.utils.check_array(self.allData, ensure_2d=False)
+        # text chunks are mapped through their cache. when the cache could
+        # not be written the chunk is parsed into RAM
+        self.allData = load_chunk(self.path, mmap=mmap or columns is not None)
+        self.mmap = isinstance(self.allData, np.memmap)
+
+        # the whole file, mapped or not, is checked for NaN and infinity once
+        summary = validate_chunk(self.path, self.allData)
+
+        # with columns only those columns are read out of the mapping into RAM
+        if columns is not None:
+            self.allData = np.array(self.allData[:, columns])
+            self.mmap = False
+
+        # chunks in RAM are cast to the storage dtype once. a mapped chunk
+        # keeps the dtype of its file and is cast one batch at a time
+        if dtype is not None and not self.mmap:
+            if np.dtype(dtype).kind == 'f' and summary['max_abs'] > float(np.finfo(dtype).max):
+                raise ValueError("%s has values too large for %s" % (self.path, np.dtype(dtype)))
+            self.allData = self.allData.astype(dtype, copy=False)
+
+        # batches are never smaller than float32, which is what the graphs
+        # feed. float16 storage is upcast in get_amount
+        self.batch_dtype = np.dtype(dtype) if dtype is not None else self.allData.dtype
+        if self.batch_dtype == np.float16:
+            self.batch_dtype = np.dtype(np.float32)
 
         # if the dataset is 1D, like dosage features, make it 2D
         if len(self.allData.shape) == 1:
@@ -31,25 +286,56 @@ class SingleChunk:
         self.numSamples = self.allData.shape[0]
         self.numFeatures = self.allData.shape[1]
 
+        # rows are shuffled through this index instead of moving allData around.
+        # None means file order
+        self.order = None
+
         self.currentIndex = 0
 
     # will try to return the amount. might be < amount
-    def get_amount(self, amount):
+    # without out, an unshuffled chunk returns a view. with out, the rows are
+    # copied into the front of out and that part of out is returned
+    def get_amount(self, amount, out=None):
         loop = False
-        if self.currentIndex+amount >= self.numSamples:
-            result = self.allData[self.currentIndex:]
+        stop = min(self.currentIndex+amount, self.numSamples)
+        if out is None:
+            if self.order is None:
+                result = self.allData[self.currentIndex:stop]
+            else:
+                result = self.allData[self.order[self.currentIndex:stop]]
+            if result.dtype != self.batch_dtype:
+                result = result.astype(self.batch_dtype)
         else:
-            result = self.allData[self.currentIndex: \
-                        self.currentIndex+amount]
+            result = out[:stop-self.currentIndex]
+            if self.order is None:
+                result[...] = self.allData[self.currentIndex:stop]
+            elif self.allData.dtype == result.dtype:
+                np.take(self.allData, self.order[self.currentIndex:stop], axis=0, out=result)
+            else:
+                # np.take can't cast into out
+                result[...] = self.allData[self.order[self.currentIndex:stop]]
 
         self.currentIndex += amount
         return result
 
+    def remaining(self):
+        return max(self.numSamples - self.currentIndex, 0)
+
     def reset(self):
         self.currentIndex = 0
 
-    def randomize(self):
-        np.random.shuffle(self.allData)
+    def randomize(self, order=None):
+        # order is a permutation of the rows, shared with the other chunks in a ChunkGroup
+        if order is None:
+            order = np.random.permutation(self.numSamples)
+
+        assert len(order) == self.numSamples
+        self.order = order
+
+    # serve only these rows, in this order
+    def select(self, rows):
+        self.order = rows
+        self.numSamples = len(rows)
 
     def all(self):
         return self.allData
@@ -65,17 +351,17 @@ class SingleChunkLabel(SingleChunk):
     def __init__(self, path='', batch_size=32):
         self.path = path
         self.batch_size = batch_size
-        if path.endswith('.npy'):
-            self.allData = np.load(self.path)
-        else:
-            self.allData = np.loadtxt(self.path, dtype="float")
-
-        sklearn.utils.check_array(self.allData, ensure_2d=False)
+        self.allData = load_chunk(self.path)
+        validate_chunk(self.path, self.allData)
 
         self.numSamples = self.allData.shape[0]
         # regression labels
         self.numClasses = 1
 
+        self.mmap = False
+        self.order = None
+        self.batch_dtype = self.allData.dtype
+
         self.currentIndex = 0
 
 # one label chunk
@@ -83,33 +369,163 @@ class KeyedSingleChunkLabel(SingleChunk):
     def __init__(self, path='', batch_size=32):
         self.path = path
         self.batch_size = batch_size
-        if path.endswith('.npy'):
-            self.allData = np.load(self.path)
-        else:
-            self.allData = np.loadtxt(self.path, dtype="float")
-
-        sklearn.utils.check_array(self.allData, ensure_2d=False)
+        self.allData = load_chunk(self.path)
+        validate_chunk(self.path, self.allData)
 
         self.numSamples = self.allData.shape[0]
+        # keys stay in file order, self.order maps batch rows back to them
         self.keys = self.allData[:,0]
         self.allData = self.allData[:,1]
         # regression labels
         self.numClasses = 1
 
+        self.mmap = False
+        self.order = None
+        self.batch_dtype = self.allData.dtype
+
         self.currentIndex = 0
 
-    def randomize(self):
-        rng_state = np.random.get_state()
-        np.random.shuffle(self.allData)
-        np.random.set_state(rng_state)
-        np.random.shuffle(self.keys)
+# loads one chunk on a background thread
+class ChunkLoader(object):
+    def __init__(self, chunk_class, path, **kwargs):
+        self.path = path
+        self.chunk = None
+        self.error = None
+        self.thread = threading.Thread(target=self.load, args=(chunk_class, kwargs))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load(self, chunk_class, kwargs):
+        try:
+            self.chunk = chunk_class(self.path, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    # waits for the load to finish. load errors are raised here
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.chunk
+
+# rows by index, for the views below: an int, a slice or an array of rows
+def view_rows(index, num_rows):
+    if isinstance(index, slice):
+        return np.arange(*index.indices(num_rows))
+    rows = np.asarray(index)
+    if rows.dtype == bool:
+        return np.flatnonzero(rows)
+    return np.where(rows < 0, rows + num_rows, rows)
+
+# the rows of several chunks as one read only 2D array. nothing is read until
+# rows are indexed, and then only those rows. parts are usually memory mapped
+# chunks. columns selects columns of every part, rows come out as dtype
+class ConcatenatedView(object):
+    def __init__(self, parts, dtype, columns=None):
+        self.parts = [p.reshape(-1, 1) if p.ndim == 1 else p for p in parts]
+        self.columns = columns
+        self.dtype = np.dtype(dtype)
+
+        sizes = [p.shape[0] for p in self.parts]
+        # global row number of the first row of every part, and the total
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        width = self.parts[0].shape[1] if columns is None else len(columns)
+        self.shape = (int(self.offsets[-1]), width)
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+    def __getitem__(self, index):
+        columns = None
+        if isinstance(index, tuple):
+            index, columns = index
+
+        if isinstance(index, (int, np.integer)):
+            return self[[index]][0] if columns is None else self[[index], columns][0]
+
+        rows = view_rows(index, self.shape[0])
+        part_index = np.searchsorted(self.offsets, rows, side='right') - 1
+        local = rows - self.offsets[part_index]
+        out = np.empty((len(rows), self.shape[1]), dtype=self.dtype)
+        for p in np.unique(part_index):
+            mask = part_index == p
+            if self.columns is None:
+                out[mask] = self.parts[p][local[mask]]
+            else:
+                out[mask] = self.parts[p][local[mask]][:, self.columns]
+
+        if columns is not None:
+            out = out[:, columns]
+        return out
+
+    def __array__(self, dtype=None):
+        out = self[:]
+        if dtype is not None:
+            out = out.astype(dtype, copy=False)
+        return out
+
+# the rows of a lookup table named by ids, see LookupChunkData
+class LookupView(ConcatenatedView):
+    def __init__(self, table, ids, dtype):
+        self.table = table
+        self.ids = ids
+        self.dtype = np.dtype(dtype)
+        self.shape = (len(ids), table.shape[1])
+        self.ndim = 2
+
+    def __getitem__(self, index):
+        columns = None
+        if isinstance(index, tuple):
+            index, columns = index
+
+        if isinstance(index, (int, np.integer)):
+            return self[[index]][0] if columns is None else self[[index], columns][0]
+
+        out = self.table[self.ids[view_rows(index, self.shape[0])]]
+        if out.dtype != self.dtype:
+            out = out.astype(self.dtype)
+        if columns is not None:
+            out = out[:, columns]
+        return out
 
 # takes in multiple chunks. iterates through them all. min size 1
 class ChunkData(object):
-    def __init__(self, paths=[], batch_size=32, start_chunk=0, preprocessor=None):
+    # the class used to load each chunk
+    chunk_class = SingleChunk
+
+    def __init__(self, paths=[], batch_size=32, start_chunk=0, preprocessor=None, mmap=False, \
+                batch_buffers=0, preload=False, dtype=None, columns=None):
         self.paths = paths
         self.batch_size = batch_size
 
+        # passed on to chunk_class every time a chunk is loaded
+        self.load_args = {'mmap':mmap, 'dtype':dtype}
+        if columns is not None:
+            self.load_args['columns'] = columns
+
+        # with preload the next chunk is read on a background thread while the
+        # current one is used. this holds two chunks in memory instead of one
+        self.preload = preload
+        self.next_chunk = None
+
+        # batches that need a copy are written into a ring of this many
+        # preallocated arrays. 0 allocates a new array for each of them
+        self.set_batch_buffers(batch_buffers)
+
+        # when set, every chunk is shuffled as soon as it is loaded
+        self.shuffle_seed = None
+
+        # (index, count) serves only every count-th row of each chunk, see ChunkGroup.shard
+        self.row_shard = None
+
+        # chunk_index walks through the files in this order
+        self.file_order = list(range(len(paths)))
+
         self.chunk_index = start_chunk - 1
         self.iterate_file()
         self.numFeatures = self.current_set.numFeatures
@@ -123,26 +539,126 @@ class ChunkData(object):
             return True
 
         self.chunk_index += 1
-        self.current_set = SingleChunk(self.paths[self.chunk_index], \
-                            batch_size=self.batch_size)
+        self.current_set = self.load_current()
         self.allData = self.current_set.allData
 
+        # shuffle before the chunk serves any rows
+        self.apply_order()
+
+        # a single chunk would just be held twice
+        if self.preload and len(self.paths) > 1:
+            self.start_preload()
+
         return False
 
+    def load_current(self):
+        path = self.current_path()
+        loader, self.next_chunk = self.next_chunk, None
+        # a preloaded chunk is only used if it is the one we need. the file
+        # order can change between preloading and reaching the next chunk
+        if loader is not None and loader.path == path:
+            return loader.result()
+
+        return self.chunk_class(path, batch_size=self.batch_size, **self.load_args)
+
+    # starts reading the chunk after the current one. after the last chunk
+    # that's the first chunk of the next epoch
+    def start_preload(self):
+        next_index = (self.chunk_index + 1) % len(self.paths)
+        self.next_chunk = ChunkLoader(self.chunk_class, self.paths[self.file_order[next_index]], \
+                            batch_size=self.batch_size, **self.load_args)
+
+    def current_path(self):
+        return self.paths[self.file_order[self.chunk_index]]
+
+    # takes effect the next time a chunk is loaded, normally on reset
+    def set_file_order(self, file_order):
+        assert sorted(file_order) == list(range(len(self.paths)))
+        self.file_order = list(file_order)
+
+    # the permutation for the current chunk. every ChunkData given the same
+    # seed produces the same permutation, which keeps feature sets and labels aligned
+    def chunk_order(self):
+        rng = np.random.RandomState((self.shuffle_seed + self.file_order[self.chunk_index]) % (2**32))
+        return rng.permutation(self.current_set.allData.shape[0])
+
+    # sets the row order of the current chunk from the shuffle seed and the row shard
+    def apply_order(self):
+        order = None
+        if self.shuffle_seed is not None:
+            order = self.chunk_order()
+
+        if self.row_shard is not None:
+            index, count = self.row_shard
+            if order is None:
+                order = np.arange(self.current_set.allData.shape[0])
+            self.current_set.select(order[index::count])
+        elif order is not None:
+            self.current_set.randomize(order)
+
+    def set_paths(self, paths):
+        self.paths = paths
+        self.num_chunks = len(paths)
+        self.file_order = list(range(len(paths)))
+        self.next_chunk = None
+
+    def set_batch_buffers(self, batch_buffers):
+        self.batch_buffers = batch_buffers
+        self.buffers = None
+        self.buffer_index = 0
+
+    # an array to copy the next batch into
+    def batch_buffer(self):
+        shape = (self.batch_size,) + self.current_set.allData.shape[1:]
+        dtype = self.current_set.batch_dtype
+        if self.batch_buffers == 0:
+            return np.empty(shape, dtype=dtype)
+
+        if self.buffers is None or self.buffers[0].shape != shape or self.buffers[0].dtype != dtype:
+            self.buffers = [np.empty(shape, dtype=dtype) for i in range(self.batch_buffers)]
+            self.buffer_index = 0
+
+        buf = self.buffers[self.buffer_index]
+        self.buffer_index = (self.buffer_index + 1) % self.batch_buffers
+        return buf
+
+    # a batch inside the current chunk: a view when the chunk is in file
+    # order, a single gather into a batch buffer when it is shuffled
+    def get_chunk_batch(self):
+        if self.current_set.order is None:
+            return self.current_set.get_amount(self.batch_size)
+        else:
+            return self.current_set.get_amount(self.batch_size, out=self.batch_buffer())
+
+    # a batch that crosses chunks. every piece is copied straight into one
+    # batch buffer. with wrap the data restarts at the first chunk,
+    # otherwise the batch stops short at the end of the last chunk
+    def get_crossing_batch(self, wrap):
+        data = self.batch_buffer()
+        filled = 0
+        looped = False
+        while filled < self.batch_size:
+            if self.current_set.is_empty():
+                if not self.is_last_chunk():
+                    self.iterate_file()
+                elif wrap:
+                    self.reset()
+                    looped = True
+                else:
+                    break
+
+            filled += self.current_set.get_amount(self.batch_size-filled, out=data[filled:]).shape[0]
+
+        return data[:filled], looped
+
     # must return batch_size samples. will repeat across chunks until done
     def get_next_batch(self):
         # must always return some data. can't be empty
-        data = self.current_set.get_amount(self.batch_size)
-        looped = False
-        while data.shape[0] < self.batch_size:
-            # current_set must be empty. either reset or iterate
-            if self.is_last_chunk():
-                self.reset()
-                looped = True
-            else:
-                self.iterate_file()
-            new_data = self.current_set.get_amount(self.batch_size-data.shape[0])
-            data = np.concatenate([data, new_data], axis=0)
+        if self.current_set.remaining() >= self.batch_size:
+            data = self.get_chunk_batch()
+            looped = False
+        else:
+            data, looped = self.get_crossing_batch(wrap=True)
 
         if self.current_set.is_empty():
             if self.is_last_chunk():
@@ -158,23 +674,19 @@ class ChunkData(object):
         if self.current_set.is_empty() and self.is_last_chunk():
             return np.array([]), True
 
-        data = None
+        if self.current_set.remaining() >= self.batch_size:
+            data = self.get_chunk_batch()
+        else:
+            data, looped = self.get_crossing_batch(wrap=False)
+
         empty = False
-        while data is None or data.shape[0] < self.batch_size:
-            if data is None:
-                data = self.current_set.get_amount(self.batch_size)
+        if self.current_set.is_empty():
+            if self.is_last_chunk():
+                # totally out of data
+                empty = True
             else:
-                new_data = self.current_set.get_amount(self.batch_size-data.shape[0])
-                data = np.concatenate([data, new_data], axis=0)
-
-            if self.current_set.is_empty():
-                if self.is_last_chunk():
-                    # totally out of data
-                    empty = True
-                    break
-                else:
-                    # just need to iterate to next file
-                    self.iterate_file()
+                # just need to iterate to next file
+                self.iterate_file()
 
         return data, empty
 
@@ -183,11 +695,43 @@ class ChunkData(object):
 
         self.iterate_file()
 
-    def randomize(self):
-        self.current_set.randomize()
+    def randomize(self, seed=None):
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
 
-    def all(self):
-        return self.current_set.allData # definitely can't do this, so we cheat
+        self.shuffle_seed = seed
+        self.apply_order()
+
+    # the exact position: chunk, row offset and the seed the row order comes from
+    def get_state(self):
+        return {'chunk_index':self.chunk_index, 'file_order':list(self.file_order), 
+                'shuffle_seed':self.shuffle_seed, 'current_index':self.current_set.currentIndex}
+
+    def set_state(self, state):
+        self.set_file_order(state['file_order'])
+        self.shuffle_seed = state['shuffle_seed']
+        self.next_chunk = None
+        self.chunk_index = state['chunk_index'] - 1
+        self.iterate_file()
+        self.current_set.currentIndex = state['current_index']
+
+    # every chunk, in file order, as one lazy array. rows are read when indexed
+    def view(self):
+        parts = []
+        for path in self.paths:
+            part = load_chunk(path, mmap=True)
+            validate_chunk(path, part)
+            parts.append(part)
+        return ConcatenatedView(parts, self.batch_dtype, self.load_args.get('columns'))
+
+    # the whole split in file order, whatever chunk is current. one array
+    # when it takes at most memory_budget bytes (None for no limit), the lazy
+    # view otherwise
+    def all(self, memory_budget=None):
+        view = self.view()
+        if memory_budget is None or view.nbytes <= memory_budget:
+            return view[:]
+        return view
 
     def set_all(self, mat):
         self.current_set.set_all(mat)
@@ -201,49 +745,147 @@ class ChunkData(object):
     def is_empty(self):
         return self.current_set.is_empty()
 
+    # the dtype of the feature batches
+    @property
+    def batch_dtype(self):
+        return self.current_set.batch_dtype
+
+    # the array the features are read from and whether it is memory mapped
+    def stored(self):
+        return self.current_set.allData, self.current_set.mmap
+
     def get_preprocessor(self):
         return None
 
     def load_preprocessor(self, preprocessor):
         pass
 
+# a feature set stored as row ids into a table of unique feature vectors, like
+# the drug descriptors or the expression of a cell line that every response row
+# would otherwise repeat. the chunks hold one id per sample and go through
+# ChunkData as usual, the vectors are gathered from the table per batch.
+# batch_buffers only recycles the id arrays
+class LookupChunkData(ChunkData):
+    def __init__(self, paths=[], table_path='', batch_size=32, start_chunk=0, preprocessor=None, \
+                mmap=False, batch_buffers=0, preload=False, dtype=None, columns=None):
+        # the table is loaded like a chunk
+        table = SingleChunk(table_path, batch_size, mmap=mmap, dtype=dtype, columns=columns)
+        self.table = table.allData
+        self.table_mmap = table.mmap
+        self.table_dtype = table.batch_dtype
+
+        # ids are small, they are always loaded into memory and never cast
+        super(LookupChunkData, self).__init__(paths, batch_size, start_chunk, preprocessor, \
+            mmap=False, batch_buffers=batch_buffers, preload=preload)
+
+        self.numFeatures = self.table.shape[1]
+
+    def iterate_file(self):
+        if super(LookupChunkData, self).iterate_file():
+            return True
+
+        # text id chunks are parsed as floats
+        ids = self.current_set.allData.reshape(-1).astype(np.int64)
+        if ids.size > 0 and (ids.min() < 0 or ids.max() >= self.table.shape[0]):
+            raise ValueError("%s has ids outside of the %d rows of its table" % \
+                (self.current_path(), self.table.shape[0]))
+
+        self.current_set.allData = ids
+        self.current_set.batch_dtype = ids.dtype
+        self.allData = ids
+
+        return False
+
+    def lookup(self, ids):
+        rows = self.table[ids.astype(np.int64)]
+        if rows.dtype != self.table_dtype:
+            rows = rows.astype(self.table_dtype)
+        return rows
+
+    def get_next_batch(self):
+        ids, loop = super(LookupChunkData, self).get_next_batch()
+        return self.lookup(ids), loop
+
+    def get_onetime_batch(self):
+        ids, empty = super(LookupChunkData, self).get_onetime_batch()
+        return self.lookup(ids), empty
+
+    # ids are small, the vectors are gathered when rows are indexed
+    def view(self):
+        ids = [self.chunk_class(path, batch_size=self.batch_size).allData.reshape(-1) for path in self.paths]
+        return LookupView(self.table, np.concatenate(ids).astype(np.int64), self.table_dtype)
+
+    @property
+    def batch_dtype(self):
+        return self.table_dtype
+
+    def stored(self):
+        return self.table, self.table_mmap
+
 # special class for dealing with labels.
 class ChunkDataLabel(ChunkData):
-    def __init__(self, paths=[], batch_size=32, start_chunk=0, preprocessor=None):
+    chunk_class = SingleChunkLabel
+
+    def __init__(self, paths=[], batch_size=32, start_chunk=0, preprocessor=None, int_labels=False, \
+                vocabulary_fn=None):
         self.paths = paths
         self.num_chunks = len(paths)
         self.batch_size = batch_size
 
+        # label chunks are small, they are always loaded into memory
+        self.load_args = {}
+        self.preload = False
+        self.next_chunk = None
+        self.set_batch_buffers(0)
+        self.shuffle_seed = None
+        self.row_shard = None
+        self.file_order = list(range(len(paths)))
+
+        # switched on below, once the classes are known
+        self.int_labels = False
+
         self.chunk_index = start_chunk - 1
         self.iterate_file()
 
-        self.init_classes(preprocessor)
+        self.init_classes(preprocessor, vocabulary_fn)
+
+        # with int_labels every chunk is converted to int32 class ids once, when
+        # it is loaded. batches skip the encoder and the graph one hot encodes them
+        if int_labels and self.encoder is not None:
+            self.int_labels = True
+            self.convert_chunk()
 
     def iterate_file(self):
-        if self.chunk_index+1 >= len(self.paths):
+        if super(ChunkDataLabel, self).iterate_file():
             return True
 
-        self.chunk_index += 1
-        self.current_set = SingleChunkLabel(self.paths[self.chunk_index], \
-                            batch_size=self.batch_size)
+        if self.int_labels:
+            self.convert_chunk()
+
         return False
 
-    def init_classes(self, preprocessor):
+    # the index in self.classes of every label
+    def class_ids(self, labels, path):
+        ids = np.minimum(np.searchsorted(self.classes, labels), len(self.classes)-1)
+        if not np.array_equal(self.classes[ids], labels):
+            raise ValueError("%s has labels the encoder has not seen" % path)
+        return ids.astype(np.int32)
+
+    # replaces the labels of the current chunk with their index in self.classes
+    def convert_chunk(self):
+        self.current_set.allData = self.class_ids(self.current_set.allData, self.current_path())
+        self.current_set.batch_dtype = self.current_set.allData.dtype
+        self.allData = self.current_set.allData
+
+    def init_classes(self, preprocessor, vocabulary_fn=None):
         path = self.paths[0]
         if '.y.' in path or '.lab.' in path or path.endswith('.y'):
             if preprocessor is None:
-                # loop through all labels and convert to one hot encoding
-                labels = []
-                loop = False
-                while not loop:
-                    l, loop = super(ChunkDataLabel, self).get_onetime_batch()
-                    labels.append(l)
-                self.reset()
-
-                # reshape to something sklearn likes
-                all_labels = np.concatenate(labels).reshape(-1, 1)
+                # fitting on the unique labels gives the same encoder as
+                # fitting on every label. reshape to something sklearn likes
+                classes = label_vocabulary(self.paths, vocabulary_fn).reshape(-1, 1)
                 preprocessor = OneHotEncoder(sparse=False)
-                preprocessor.fit(all_labels)
+                preprocessor.fit(classes)
 
             self.load_preprocessor(preprocessor)
 
@@ -266,11 +908,13 @@ class ChunkDataLabel(ChunkData):
         else:
             self.encoder = preprocessor
             self.numClasses = self.encoder.n_values_[0]
+            # the label of every one hot column, in column order
+            self.classes = self.encoder.inverse_transform(np.eye(self.numClasses)).reshape(-1)
 
     def get_next_batch(self):
         labels, loop = super(ChunkDataLabel, self).get_next_batch()
 
-        if self.encoder is None:
+        if self.encoder is None or self.int_labels:
             return labels, loop
         else:
             labels = labels.reshape(-1, 1)
@@ -281,7 +925,7 @@ class ChunkDataLabel(ChunkData):
     def get_onetime_batch(self):
         labels, loop = super(ChunkDataLabel, self).get_onetime_batch()
 
-        if self.encoder is None:
+        if self.encoder is None or self.int_labels:
             return labels, loop
         else:
             labels = labels.reshape(-1, 1)
@@ -289,30 +933,287 @@ class ChunkDataLabel(ChunkData):
 
             return transformed, loop
 
+    # every label of the split in file order, as class ids with int_labels.
+    # labels are small, they are always returned as one array
+    def all(self, memory_budget=None):
+        labels = []
+        for path in self.paths:
+            chunk_labels = self.chunk_class(path, batch_size=self.batch_size).allData
+            if self.int_labels:
+                chunk_labels = self.class_ids(chunk_labels, path)
+            labels.append(chunk_labels)
+        return np.concatenate(labels)
+
     def inverse_transform(self, labels):
         if self.encoder is None:
             return labels
+        elif self.int_labels:
+            # class ids, from the dataset or an argmax in the graph
+            return self.classes[labels]
         else:
             return self.encoder.inverse_transform(labels).reshape(labels.shape[0],)
 
 # special class for dealing with labels.
 class KeyedChunkDataLabel(ChunkDataLabel):
+    chunk_class = KeyedSingleChunkLabel
+
     def iterate_file(self):
-        if self.chunk_index+1 >= len(self.paths):
+        if super(KeyedChunkDataLabel, self).iterate_file():
             return True
 
-        self.chunk_index += 1
-        self.current_set = KeyedSingleChunkLabel(self.paths[self.chunk_index], \
-                            batch_size=self.batch_size)
-        self.allData = self.current_set.allData
         self.keys = self.current_set.keys
 
         return False
 
+# mixes samples from different chunks of a ChunkGroup. rows stream in through
+# get_onetime_batch in chunk order and leave in random order. at most size rows
+# (plus one incoming batch) are held, however big the split is
+class ShuffleBuffer(object):
+    def __init__(self, group, size):
+        assert size >= group.batch_size, "shuffle buffer must hold at least one batch"
+        self.group = group
+        self.size = size
+        self.has_labels = group.labels is not None
+
+        # one array per feature set (and labels), allocated on the first fill
+        self.buffers = None
+        self.count = 0
+        self.exhausted = False
+
+        # rows are picked with a generator of its own, seeded every epoch. the
+        # position of the group when the epoch started, the seed, the rows of
+        # the epoch already in the batch that ended the last one and the
+        # batches served since are enough to fill the buffer again
+        self.rng = None
+        self.seed = None
+        self.start = None
+        self.carried = []
+        self.batches = 0
+
+    def clear(self):
+        self.count = 0
+        self.exhausted = False
+        self.start = None
+        self.carried = []
+        self.batches = 0
+
+    # called once the group is reset, before any row of the epoch is read
+    def begin(self):
+        self.seed = np.random.randint(2**31 - 1)
+        self.rng = np.random.RandomState(self.seed)
+        self.start = self.group.get_position()
+
+    def get_state(self):
+        return {'seed':self.seed, 'start':self.start, 'carried':list(self.carried), 
+                'batches':self.batches}
+
+    # serves the batches of the epoch up to the saved one again, which reads
+    # those rows a second time but keeps the state a few numbers
+    def set_state(self, state):
+        self.clear()
+        if state['start'] is None:
+            return
+
+        self.seed = state['seed']
+        self.rng = np.random.RandomState(self.seed)
+        self.start = state['start']
+        self.group.set_position(self.start)
+        for amount in state['carried']:
+            self.take(amount)
+        self.carried = list(state['carried'])
+        for _ in range(state['batches']):
+            self.get_next_batch()
+
+    def fill(self):
+        while self.count < self.size and not self.exhausted:
+            data = self.group.get_onetime_batch()
+            self.exhausted = data[-1]
+            if self.has_labels:
+                columns = data[:-1]
+            else:
+                columns = data[:-2]
+
+            amount = columns[0].shape[0]
+            if amount == 0:
+                continue
+
+            if self.buffers is None:
+                self.buffers = [np.empty((self.size+self.group.batch_size,)+c.shape[1:], dtype=c.dtype) \
+                    for c in columns]
+
+            for b, c in zip(self.buffers, columns):
+                b[self.count:self.count+amount] = c
+            self.count += amount
+
+    # removes up to amount random rows. the rows at the end of the buffer
+    # are moved into the holes so the buffer stays packed
+    def take(self, amount):
+        self.fill()
+        amount = min(amount, self.count)
+        slots = self.rng.choice(self.count, amount, replace=False)
+        taken = [b[slots] for b in self.buffers]
+
+        remaining = self.count - amount
+        holes = slots[slots < remaining]
+        movers = np.setdiff1d(np.arange(remaining, self.count), slots)
+        for b in self.buffers:
+            b[holes] = b[movers]
+        self.count = remaining
+
+        return taken
+
+    # same contract as ChunkGroup.get_next_batch
+    def get_next_batch(self):
+        if self.start is None:
+            self.begin()
+        self.batches += 1
+
+        pieces = []
+        amount = 0
+        loop = False
+        while amount < self.group.batch_size:
+            taken = self.take(self.group.batch_size - amount)
+            pieces.append(taken)
+            amount += taken[0].shape[0]
+            if loop:
+                self.carried.append(taken[0].shape[0])
+
+            if self.count == 0 and self.exhausted:
+                # every sample has been served, start the next epoch. the
+                # rest of this batch comes from it
+                loop = True
+                self.group.reset()
+                self.begin()
+
+        if len(pieces) == 1:
+            columns = pieces[0]
+        else:
+            columns = [np.concatenate(c, axis=0) for c in zip(*pieces)]
+
+        if not self.has_labels:
+            columns.append(np.array([]))
+
+        return tuple(columns) + (loop,)
+
+# hands out a fixed set of items in random order, a new order every time
+# they run out. taking n items costs O(n) amortized
+class SampleCycle(object):
+    def __init__(self, items):
+        self.items = items
+        self.order = np.random.permutation(items)
+        self.position = 0
+
+    def take(self, amount):
+        pieces = []
+        while amount > 0:
+            if self.position == len(self.order):
+                self.order = np.random.permutation(self.items)
+                self.position = 0
+            piece = self.order[self.position:self.position+amount]
+            self.position += len(piece)
+            amount -= len(piece)
+            pieces.append(piece)
+
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces)
+
+    def get_state(self):
+        return {'order':self.order, 'position':self.position}
+
+    def set_state(self, state):
+        self.order = state['order']
+        self.position = state['position']
+
+# builds every batch of a ChunkGroup from P classes with K samples each, so
+# every class shows up in batches at the same rate however rare it is. the
+# class of every row in the split is read once from the label files into a
+# row index per class. rows are gathered through the view of every feature
+# set, which maps the chunks, so a batch costs O(P*K). text chunks that could
+# not be cached are held in RAM instead
+class PKSampler(object):
+    def __init__(self, group, P, K, row_shard=None):
+        labels = group.labels
+        if labels is None or labels.encoder is None:
+            raise ValueError("the P x K sampler needs class labels")
+
+        self.group = group
+        self.P = P
+        self.K = K
+        self.classes = labels.classes
+
+        self.views = [feat.view() for feat in group.features]
+
+        # global row numbers of every class
+        chunk_ids = [labels.class_ids(load_chunk(path), path) for path in labels.paths]
+        ids = np.concatenate(chunk_ids)
+        rows = np.arange(len(ids))
+        if row_shard is not None:
+            # only this shard's rows of every chunk, see ChunkGroup.shard
+            index, count = row_shard
+            local = np.concatenate([np.arange(len(c)) for c in chunk_ids])
+            keep = local % count == index
+            ids = ids[keep]
+            rows = rows[keep]
+
+        by_class = np.argsort(ids, kind='mergesort')
+        present, starts = np.unique(ids[by_class], return_index=True)
+        self.class_rows = dict((c, SampleCycle(r)) for c, r in \
+            zip(present, np.split(rows[by_class], starts[1:])))
+        self.class_cycle = SampleCycle(present)
+
+        # an epoch is as many batches as it takes to cover the rows once
+        self.epoch_batches = max(int(math.ceil(len(rows) / (P*K))), 1)
+        self.batch_count = 0
+
+        print("P x K sampler: %d classes with samples, %d batches of %d x %d per epoch" % \
+            (len(present), self.epoch_batches, P, K))
+
+    # same contract as ChunkGroup.get_next_batch
+    def get_next_batch(self):
+        classes = self.class_cycle.take(self.P)
+        rows = np.concatenate([self.class_rows[c].take(self.K) for c in classes])
+        ids = np.repeat(classes, self.K)
+
+        fs = [view[rows] for view in self.views]
+
+        labels = self.group.labels
+        if labels.int_labels:
+            ls = ids.astype(np.int32)
+        else:
+            ls = labels.encoder.transform(self.classes[ids].reshape(-1, 1))
+
+        self.batch_count += 1
+        loop = self.batch_count == self.epoch_batches
+        if loop:
+            self.batch_count = 0
+
+        return tuple(fs) + (ls, loop)
+
+    def get_state(self):
+        return {'batch_count':self.batch_count, 'class_cycle':self.class_cycle.get_state(), 
+                'class_rows':dict((c, cycle.get_state()) for c, cycle in self.class_rows.items())}
+
+    def set_state(self, state):
+        self.batch_count = state['batch_count']
+        self.class_cycle.set_state(state['class_cycle'])
+        for c, cycle in self.class_rows.items():
+            cycle.set_state(state['class_rows'][c])
+
 # keeps several ChunkData and ChunkDataLabel objects aligned
 class ChunkGroup(object):
     def __init__(self, pathFeatures=[['']], pathLabels=[], batch_size=32, shuffle=True, \
-                preprocessing_fn='no_preprocessors.pkl'):
+                preprocessing_fn='no_preprocessors.pkl', mmap=False, global_shuffle=False, \
+                shuffle_buffer=10000, batch_buffers=0, preload=False, dtype=None, int_labels=False, \
+                pk_sampler=None, tables=None, columns=None):
+        # a .cgrp container given as the first feature set holds every feature
+        # set and the labels of the split, the other paths are ignored
+        self.container = None
+        if len(pathFeatures[0]) > 0 and pathFeatures[0][0].endswith('.cgrp'):
+            self.container = Container(pathFeatures[0][0])
+            pathFeatures = self.container.feature_paths()
+            pathLabels = self.container.label_paths()
+
         print('features', pathFeatures)
         print('labels', pathLabels)
 
@@ -324,24 +1225,65 @@ class ChunkGroup(object):
         self.pathLabels = pathLabels
         self.batch_size = batch_size
 
+        # pk_sampler=(P, K) builds every batch from P classes with K samples
+        # each. the batch size becomes P*K
+        self.pk = pk_sampler
+        if self.pk is not None:
+            if global_shuffle:
+                raise ValueError("the P x K sampler can't be combined with global shuffling")
+            self.batch_size = self.pk[0] * self.pk[1]
+
+        # tables: one lookup table path per feature set, or None/'' for a set
+        # stored row by row. the chunks of a set with a table hold its row ids
+        if tables is None:
+            tables = []
+        tables = list(tables) + [None]*(len(pathFeatures)-len(tables))
+
+        # columns: one array of column indices per feature set, or None to
+        # read every column. only those columns are ever read from the chunks
+        if columns is None:
+            columns = []
+        self.columns = list(columns) + [None]*(len(pathFeatures)-len(columns))
+
         # supports multiple feature vectors per sample
         print("no progress file found. starting over")
         self.chunk_index = 0
 
         feat_pre, label_pre = self.load_preprocessing(preprocessing_fn)
+        loaded = os.path.exists(preprocessing_fn)
+        # the label vocabulary manifest sits next to the preprocessing pickle,
+        # so every dataset of a run shares it
+        self.vocabulary_fn = os.path.splitext(preprocessing_fn)[0] + '.vocab.json'
+
+        # mmap serves batches straight from the mapped .npy chunks instead of loading them
+        self.mmap = mmap
+        # batch_buffers > 0 recycles preallocated batch arrays, so a batch is
+        # only valid until that many more batches have been read
+        self.features = []
+        for i, path_feature in enumerate(self.pathFeatures):
+            if tables[i]:
+                self.features.append(LookupChunkData(path_feature, tables[i], self.batch_size, 
+                    start_chunk=self.chunk_index, preprocessor=feat_pre[i], \
+                    mmap=self.mmap, batch_buffers=batch_buffers, preload=preload, dtype=dtype, 
+                    columns=self.columns[i]))
+            else:
+                self.features.append(ChunkData(path_feature, self.batch_size, 
+                    start_chunk=self.chunk_index, preprocessor=feat_pre[i], \
+                    mmap=self.mmap, batch_buffers=batch_buffers, preload=preload, dtype=dtype, 
+                    columns=self.columns[i]))
+        self.report_storage()
 
-        self.features = [ChunkData(path_feature, self.batch_size, start_chunk=self.chunk_index, preprocessor=feat_pre[i]) \
-                            for i,path_feature in enumerate(self.pathFeatures)]
+        # int_labels serves class labels as int32 ids instead of one hot rows
+        self.int_labels = int_labels
 
         # moved this to a function to allow for easy implementation of keyed labels
         self.load_labels(label_pre)
 
-        self.save_preprocessing(preprocessing_fn)
-
-        # randomize the first chunk
-        self.shuffle = shuffle
-        if self.shuffle:
-            self.randomize()
+        # only written when something was fitted here, groups that load
+        # everything from it, like the other workers', leave it alone
+        if not loaded or (label_pre is None and self.labels is not None and \
+                self.labels.get_preprocessor() is not None):
+            self.save_preprocessing(preprocessing_fn)
 
         # numFeatures is the sum of all feature sets
         total_features = 0
@@ -357,6 +1299,25 @@ class ChunkGroup(object):
             assert self.num_chunks == self.labels.num_chunks, \
                 "num_chunks %d labels.num_chunks %d" % (self.num_chunks, self.labels.num_chunks)
 
+        # global_shuffle visits the chunks in a new order every epoch and mixes
+        # samples across chunks through a buffer of shuffle_buffer rows
+        self.file_order = list(range(self.num_chunks))
+        self.global_shuffle = global_shuffle
+        if self.global_shuffle:
+            self.shuffle_buffer = ShuffleBuffer(self, shuffle_buffer)
+            self.reset()
+        else:
+            self.shuffle_buffer = None
+
+        self.pk_sampler = None
+        if self.pk is not None:
+            self.pk_sampler = PKSampler(self, *self.pk)
+
+        # randomize the first chunk
+        self.shuffle = shuffle
+        if self.shuffle:
+            self.randomize()
+
         # make sure all current chunks are the same size
         self.current_chunk_size_check()
 
@@ -371,7 +1332,12 @@ class ChunkGroup(object):
         else:
             label_pre = self.labels.get_preprocessor()
 
-        pkl.dump({'feat_pre':feat_pre, 'label_pre':label_pre}, open(preprocessing_fn, 'wb'))
+        # written to a temporary file and renamed, so a reader never sees
+        # half of it
+        tmp_fn = preprocessing_fn + '.%d.tmp' % os.getpid()
+        with open(tmp_fn, 'wb') as f:
+            pkl.dump({'feat_pre':feat_pre, 'label_pre':label_pre}, f)
+        os.rename(tmp_fn, preprocessing_fn)
 
     def load_preprocessing(self, preprocessing_fn):
         # input:
@@ -390,7 +1356,8 @@ class ChunkGroup(object):
     def load_labels(self, label_pre):
         if len(self.pathLabels) > 0:
             self.labels = ChunkDataLabel(self.pathLabels, self.batch_size, 
-                start_chunk=self.chunk_index, preprocessor=label_pre)
+                start_chunk=self.chunk_index, preprocessor=label_pre, int_labels=self.int_labels, \
+                vocabulary_fn=self.vocabulary_fn)
             self.numClasses = self.labels.numClasses
         else:
             self.labels = None
@@ -407,6 +1374,11 @@ class ChunkGroup(object):
         assert all([corret_size == a_file.current_chunk_size() for a_file in all_files])
 
     def get_next_batch(self):
+        if self.pk_sampler is not None:
+            return self.pk_sampler.get_next_batch()
+        if self.shuffle_buffer is not None:
+            return self.shuffle_buffer.get_next_batch()
+
         # check chunk alignment
         files = self.features + [self.labels]
         for f in files:
@@ -436,8 +1408,7 @@ class ChunkGroup(object):
             # make sure all current chunks are the same size
             self.current_chunk_size_check()
 
-            if self.shuffle:
-                self.randomize()
+            # the new chunk was already shuffled when it was loaded
             self.chunk_index = new_chunk_index
 
         return data
@@ -467,9 +1438,6 @@ class ChunkGroup(object):
             self.current_chunk_size_check()
             self.chunk_index = new_chunk_index
 
-            if self.shuffle:
-                self.randomize()
-
         return data
 
     def get_all_label_names(self):
@@ -491,10 +1459,10 @@ class ChunkGroup(object):
             if len(self.pathLabels) == 0 or "NCIPDM" in self.pathFeatures[0][0]:
                 # hard code this to use the dosage as the name if no labels
                 # or for NCIPDM dataset
-                return self.pathFeatures[2][self.chunk_index]
+                return self.pathFeatures[2][self.file_order[self.chunk_index]]
             else:
                 #print("len pathLabels", len(self.pathLabels), "chunk_index", self.chunk_index)
-                return self.pathLabels[self.chunk_index]
+                return self.pathLabels[self.file_order[self.chunk_index]]
         else:
             # if you're out of samples, return ''
             return ''
@@ -503,27 +1471,122 @@ class ChunkGroup(object):
         return self.features[0].is_empty()
 
     def reset(self):
+        if self.global_shuffle:
+            self.shuffle_buffer.clear()
+            self.file_order = [int(i) for i in np.random.permutation(self.num_chunks)]
+
         for feat in self.features:
+            feat.set_file_order(self.file_order)
             feat.reset()
 
         if not self.labels is None:
+            self.labels.set_file_order(self.file_order)
             self.labels.reset()
 
         self.chunk_index = 0
 
-    def randomize(self):
-        rng_state = np.random.get_state()
-        for cd in self.features+[self.labels]:
-            cd.randomize()
-            np.random.set_state(rng_state)
+    # where the group is in its data: the position of every feature set and
+    # the labels, the chunk order and the numpy RNG
+    def get_position(self):
+        position = {'chunk_index':self.chunk_index, 'file_order':list(self.file_order), 
+                'features':[feat.get_state() for feat in self.features], 
+                'labels':None, 'rng':np.random.get_state()}
+        if self.labels is not None:
+            position['labels'] = self.labels.get_state()
+        return position
+
+    def set_position(self, position):
+        self.file_order = list(position['file_order'])
+        for feat, feat_state in zip(self.features, position['features']):
+            feat.set_state(feat_state)
+        if self.labels is not None:
+            self.labels.set_state(position['labels'])
+        self.chunk_index = position['chunk_index']
+        np.random.set_state(position['rng'])
+
+    # everything needed to continue from the next batch: the position and,
+    # with global shuffling or pk sampling, how to rebuild their state
+    def get_state(self):
+        state = self.get_position()
+        state['shuffle_buffer'] = None
+        state['pk_sampler'] = None
+        if self.pk_sampler is not None:
+            state['pk_sampler'] = self.pk_sampler.get_state()
+        if self.shuffle_buffer is not None:
+            state['shuffle_buffer'] = self.shuffle_buffer.get_state()
+        return state
+
+    def set_state(self, state):
+        # the shuffle buffer refills by replaying from the start of the epoch,
+        # the position is set after it
+        if self.shuffle_buffer is not None:
+            self.shuffle_buffer.set_state(state['shuffle_buffer'])
+        self.set_position(state)
+        if self.pk_sampler is not None:
+            self.pk_sampler.set_state(state['pk_sampler'])
+
+    # restricts this group to shard index of count, for worker processes. whole
+    # chunks are dealt out when there are enough of them, otherwise every chunk
+    # is split by rows. with even every shard gets the same rows to within one
+    # per chunk, for workers that step in lockstep, so whole chunks are only
+    # dealt out when they split evenly. row shards only stay disjoint while
+    # every worker orders the rows with the same seed. the group restarts from
+    # the beginning of its shard, randomized with seed when there is one
+    def shard(self, index, count, seed=None, even=False):
+        sets = [(cd, paths) for cd, paths in zip(self.features+[self.labels], self.pathFeatures+[self.pathLabels]) \
+                if cd is not None]
+        whole_chunks = self.num_chunks >= count
+        if whole_chunks and even:
+            sizes = set(load_chunk(path, mmap=True).shape[0] for path in self.pathFeatures[0])
+            whole_chunks = self.num_chunks % count == 0 and len(sizes) == 1
+        if whole_chunks:
+            chunks = list(range(index, self.num_chunks, count))
+            self.pathFeatures = [[paths[c] for c in chunks] for paths in self.pathFeatures]
+            if self.labels is not None:
+                self.pathLabels = [self.pathLabels[c] for c in chunks]
+            for cd, paths in sets:
+                cd.set_paths([paths[c] for c in chunks])
+            self.num_chunks = len(chunks)
+            self.file_order = list(range(self.num_chunks))
+        else:
+            for cd, paths in sets:
+                cd.row_shard = (index, count)
+                # a preload started before the shard may belong to another process
+                cd.next_chunk = None
 
-        # with out this call, every chunk will always be randomized the same way
-        # in other words each epoch will have the same order
-        np.random.shuffle(np.zeros(4))
+        # the sampler indexes the rows of this shard only
+        if self.pk_sampler is not None:
+            row_shard = None if whole_chunks else (index, count)
+            self.pk_sampler = PKSampler(self, self.pk[0], self.pk[1], row_shard=row_shard)
 
-    def all(self):
         self.reset()
-        allFeatures = [feat.all() for feat in self.features]
+        if seed is not None:
+            self.randomize(seed)
+
+    def randomize(self, seed=None):
+        # one seed for every feature set and the labels, so they all gather
+        # rows through the same permutation. a new seed each call gives each
+        # epoch a different order. later chunks are shuffled as they load
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+        for cd in self.features+[self.labels]:
+            if cd is not None:
+                cd.randomize(seed)
+
+    # the whole split in file order: every feature set, then the labels. the
+    # feature sets are loaded into arrays in order while they fit in
+    # memory_budget bytes (None for no limit), the others are returned as
+    # lazy views that read rows when indexed
+    def all(self, memory_budget=None):
+        allFeatures = []
+        for feat in self.features:
+            view = feat.view()
+            if memory_budget is None or view.nbytes <= memory_budget:
+                allFeatures.append(view[:])
+                if memory_budget is not None:
+                    memory_budget -= view.nbytes
+            else:
+                allFeatures.append(view)
 
         if not self.labels is None:
             allLabels = self.labels.all()
@@ -532,22 +1595,360 @@ class ChunkGroup(object):
 
         return tuple(allFeatures) + (allLabels,)
 
+    # the whole split in file order, in blocks of rows whose features take at
+    # most memory_budget bytes. yields the same tuples as all()
+    def iter_all(self, memory_budget):
+        views = [feat.view() for feat in self.features]
+        row_bytes = max(sum(view.shape[1] * view.dtype.itemsize for view in views), 1)
+        step = max(int(memory_budget // row_bytes), 1)
+
+        if not self.labels is None:
+            allLabels = self.labels.all()
+        else:
+            allLabels = None
+
+        for start in range(0, views[0].shape[0], step):
+            block = tuple(view[start:start+step] for view in views)
+            if allLabels is None:
+                yield block + (np.array([]),)
+            else:
+                yield block + (allLabels[start:start+step],)
+
     def inverse_transform(self, labels):
         if self.labels is None:
             return labels
         else:
             return self.labels.inverse_transform(labels)
 
+    @classmethod
+    def from_container(cls, path, **kwargs):
+        return cls(pathFeatures=[[path]], **kwargs)
+
+    # memory held by the first chunk of every feature set, against float64
+    def report_storage(self):
+        for i, feat in enumerate(self.features):
+            data, mapped = feat.stored()
+            used = data.nbytes / 2**20
+            full = data.size * 8 / 2**20
+            where = 'mapped' if mapped else 'in memory'
+            kind = 'lookup table' if isinstance(feat, LookupChunkData) else 'per chunk'
+            print("features %d: %s %s, %.1f MB %s instead of %.1f MB as float64, batches as %s" % \
+                    (i, data.dtype, where, used, kind, full, feat.batch_dtype))
+
+    @property
+    def batch_buffers(self):
+        return self.features[0].batch_buffers
+
+    def set_batch_buffers(self, batch_buffers):
+        for feat in self.features:
+            feat.set_batch_buffers(batch_buffers)
+
 class KeyedChunkGroup(ChunkGroup):
     def load_labels(self, labels_pre):
         if len(self.pathLabels) > 0:
             self.labels = KeyedChunkDataLabel(self.pathLabels, self.batch_size, 
-                start_chunk=self.chunk_index, preprocessor=labels_pre)
+                start_chunk=self.chunk_index, preprocessor=labels_pre, int_labels=self.int_labels, \
+                vocabulary_fn=self.vocabulary_fn)
             self.numClasses = self.labels.numClasses
         else:
             self.labels = None
             self.numClasses = 0
 
+# assembles the next batches of a ChunkGroup or KeyedChunkGroup on a
+# worker thread while the network trains on the current one
+class PrefetchChunkGroup(object):
+    def __init__(self, dataset, depth=4):
+        self.dataset = dataset
+        self.depth = depth
+
+        self.batches = queue.Queue(maxsize=self.depth)
+
+        # recycled batch buffers have to outlive every queued batch, the one
+        # being trained on and the one being assembled
+        if 0 < self.dataset.batch_buffers < self.depth + 2:
+            self.dataset.set_batch_buffers(self.depth + 2)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        # with state_steps every state_steps-th batch of the epoch, counting
+        # from state_offset when an epoch is resumed, carries the dataset
+        # state right after it, so get_state matches what has been consumed,
+        # not produced
+        self.state_steps = 0
+        self.state_offset = 0
+        self.state = None
+
+    def __getattr__(self, name):
+        # everything except the prefetched calls goes straight to the dataset
+        return getattr(self.dataset, name)
+
+    def fill(self):
+        # runs on the worker thread. produces batches up to and including the
+        # one that ends the epoch, then waits for reset/randomize
+        loop = False
+        count, self.state_offset = self.state_offset, 0
+        while not loop and not self.stop_event.is_set():
+            try:
+                data = self.dataset.get_next_batch()
+            except Exception as e:
+                self.batches.put(e)
+                return
+
+            loop = data[-1]
+            count += 1
+            state = None
+            if self.state_steps > 0 and count % self.state_steps == 0 and not loop:
+                state = self.dataset.get_state()
+            while not self.stop_event.is_set():
+                try:
+                    self.batches.put((data, state), timeout=.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def start(self):
+        if self.thread is None:
+            self.state = None
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.fill)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        # throw away anything queued, the underlying dataset is about to change
+        if self.thread is None:
+            return
+
+        self.stop_event.set()
+        while self.thread.is_alive():
+            try:
+                self.batches.get(timeout=.1)
+            except queue.Empty:
+                pass
+        self.thread.join()
+        self.thread = None
+
+        while not self.batches.empty():
+            self.batches.get()
+
+    # same contract as ChunkGroup.get_next_batch: (features..., labels, loop)
+    def get_next_batch(self):
+        self.start()
+        data = self.batches.get()
+        if isinstance(data, Exception):
+            self.thread = None
+            raise data
+
+        data, self.state = data
+
+        if data[-1]:
+            # the worker is done with this epoch
+            self.thread.join()
+            self.thread = None
+
+        return data
+
+    def get_onetime_batch(self):
+        self.stop()
+        return self.dataset.get_onetime_batch()
+
+    def get_state(self):
+        if self.thread is None:
+            return self.dataset.get_state()
+        return self.state
+
+    def set_state(self, state):
+        self.stop()
+        self.dataset.set_state(state)
+
+    def reset(self):
+        self.stop()
+        self.dataset.reset()
+
+    def randomize(self, seed=None):
+        self.stop()
+        self.dataset.randomize(seed)
+
+    def all(self, memory_budget=None):
+        self.stop()
+        return self.dataset.all(memory_budget)
+
+# runs in a worker process of ProcessChunkGroup. assembles the batches of one
+# shard of the group, an epoch per command, into the worker's shared memory slots
+def batch_worker(group, index, count, slots, free, filled, commands):
+    try:
+        group.shard(index, count)
+        while True:
+            seed = commands.get()
+            if seed is None:
+                return
+
+            # every worker draws the same chunk order and shuffle seed, so
+            # row shards stay disjoint. chunk shards still differ, the
+            # permutation of a chunk depends on which chunk it is
+            if seed >= 0:
+                np.random.seed(seed)
+            group.reset()
+            if seed >= 0:
+                group.randomize()
+
+            loop = False
+            while not loop:
+                slot = free.get()
+                data = group.get_next_batch()
+                loop = data[-1]
+                rows = data[0].shape[0]
+                for view, stream in zip(slots[slot], data[:-1]):
+                    view[:rows] = stream.reshape((rows,) + view.shape[1:])
+                filled.put((index, slot, rows, loop))
+    except Exception:
+        filled.put((index, None, traceback.format_exc(), True))
+
+# assembles batches of a ChunkGroup or KeyedChunkGroup in worker processes.
+# every worker owns a shard of the chunks and a ring of depth slots in shared
+# memory. only (worker, slot, rows, loop) goes through the queues, the batch
+# itself never gets pickled. workers are forked, so the group is built once
+class ProcessChunkGroup(object):
+    # copy: return copies of the shared memory. without it a batch is a view
+    # that is only valid until the next get_next_batch
+    def __init__(self, dataset, workers=2, depth=4, copy=True):
+        self.dataset = dataset
+        self.workers = workers
+        self.depth = depth
+        self.copy = copy
+
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing
+
+        self.layout = self.stream_layout()
+        self.slots = []
+        for w in range(workers):
+            ring = []
+            for d in range(depth):
+                views = []
+                for shape, dtype in self.layout:
+                    raw = context.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+                    views.append(np.frombuffer(raw, dtype=dtype).reshape(shape))
+                ring.append(views)
+            self.slots.append(ring)
+
+        self.free = [context.Queue() for w in range(workers)]
+        self.filled = context.Queue()
+        self.commands = [context.Queue() for w in range(workers)]
+        for w in range(workers):
+            for d in range(depth):
+                self.free[w].put(d)
+
+        self.processes = []
+        for w in range(workers):
+            p = context.Process(target=batch_worker, args=(self.dataset, w, workers, \
+                    self.slots[w], self.free[w], self.filled, self.commands[w]))
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+
+        # workers still in the current epoch, and the slot of the last batch
+        # when it is handed out as a view
+        self.running = 0
+        self.held = None
+        # -1 keeps the shuffle the group already has
+        self.seed = -1
+
+    def __getattr__(self, name):
+        # everything except the batch calls goes straight to the dataset
+        return getattr(self.dataset, name)
+
+    # (shape, dtype) of every stream of a batch: the feature sets, then the labels
+    def stream_layout(self):
+        batch_size = self.dataset.batch_size
+        layout = [((batch_size, feat.numFeatures), feat.batch_dtype) \
+                    for feat in self.dataset.features]
+
+        labels = self.dataset.labels
+        if labels is not None:
+            if getattr(labels, 'encoder', None) is None:
+                layout.append(((batch_size,), labels.current_set.batch_dtype))
+            elif labels.int_labels:
+                layout.append(((batch_size,), np.dtype(np.int32)))
+            else:
+                layout.append(((batch_size, labels.numClasses), np.dtype(np.float64)))
+
+        return layout
+
+    def release(self):
+        if self.held is not None:
+            worker, slot = self.held
+            self.free[worker].put(slot)
+            self.held = None
+
+    def next_slot(self):
+        worker, slot, rows, loop = self.filled.get()
+        if slot is None:
+            raise RuntimeError("batch worker %d failed\n%s" % (worker, rows))
+        if loop:
+            self.running -= 1
+        return worker, slot, rows
+
+    # same contract as ChunkGroup.get_next_batch: (features..., labels, loop).
+    # loop is set on the batch that finishes the last worker's shard
+    def get_next_batch(self):
+        self.release()
+        if self.running == 0:
+            for commands in self.commands:
+                commands.put(self.seed)
+            self.seed = -1
+            self.running = self.workers
+
+        worker, slot, rows = self.next_slot()
+        batch = [view[:rows] for view in self.slots[worker][slot]]
+        if self.copy:
+            batch = [b.copy() for b in batch]
+            self.free[worker].put(slot)
+        else:
+            self.held = (worker, slot)
+
+        if self.dataset.labels is None:
+            batch.append(np.array([]))
+
+        return tuple(batch) + (self.running == 0,)
+
+    def reset(self):
+        # finish the epoch in progress, the next batch starts a new one
+        self.release()
+        while self.running > 0:
+            worker, slot, rows = self.next_slot()
+            self.free[worker].put(slot)
+
+    def randomize(self, seed=None):
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+        self.seed = seed
+
+    # every worker is somewhere in its own shard, there is no single position.
+    # tf_main refuses --checkpoint_steps with --batch_workers for this reason
+    def get_state(self):
+        raise ValueError("--checkpoint_steps can't save the position of --batch_workers")
+
+    def set_state(self, state):
+        raise ValueError("--checkpoint_steps can't restore the position of --batch_workers")
+
+    def get_onetime_batch(self):
+        self.reset()
+        return self.dataset.get_onetime_batch()
+
+    def all(self, memory_budget=None):
+        self.reset()
+        return self.dataset.all(memory_budget)
+
+    def stop(self):
+        self.reset()
+        for commands in self.commands:
+            commands.put(None)
+        for p in self.processes:
+            p.join()
+
 class VariableSet:
     def __init__(self, checkpoint):
         self.checkpoint = checkpoint
@@ -675,8 +2076,24 @@ def preprocessor_test():
         print('x:',x)
         print('y:',y)
 
+def vocabulary_test():
+    # a manifest is only reused for the files it was built from
+    import tempfile
+    folder = tempfile.mkdtemp()
+    manifest_fn = os.path.join(folder, 'labels.vocab.json')
+    for name, labels in [('b.y', [1, 2, 2]), ('c.y', [1, 9])]:
+        np.savetxt(os.path.join(folder, name), labels)
+
+    b = label_vocabulary([os.path.join(folder, 'b.y')], manifest_fn)
+    c = label_vocabulary([os.path.join(folder, 'c.y')], manifest_fn)
+    again = label_vocabulary([os.path.join(folder, 'c.y')], manifest_fn)
+    print('b.y:', b, 'c.y:', c)
+    assert b.tolist() == [1, 2]
+    assert c.tolist() == [1, 9] and again.tolist() == [1, 9]
+
 if __name__ == '__main__':
     #preprocessor_test()
+    #vocabulary_test()
     label_test()
 
 
@@ -4,17 +4,19 @@ import sys
 import os
 
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 import numpy as np
 from tf_layers import linear_layer
 import tf_dataset as tfd
 from tf_model import getNetwork
 from center_loss import *
 import tf_log
+import tf_checkpoint
 
 import sklearn.metrics
 
 from tf_validationInfo import RSquaredResults, CenterLossAEResults, ClassificationAutoencoderResults, \
-    ClassifierResults, AEResults
+    ClassifierResults, AEResults, BatchCostResults
 
 import timeit
 
@@ -53,34 +55,160 @@ def getOp(args):
     else:
         print("unrecognized type", t)
 
+# --feature_columns for the feature set at index, the one with the expression
+# values. None reads every column of every set
+def featureColumns(args, index):
+    if not args.feature_columns:
+        return None
+    columns, names = tfd.select_columns(args.feature_columns, args.feature_header)
+    return [None]*index + [columns]
+
+# --memory_optimizer choices
+MEMORY_OPTIMIZERS = {'default':'DEFAULT_MEM_OPT', 'off':'NO_MEM_OPT', 'manual':'MANUAL', 
+    'heuristics':'HEURISTICS', 'swapping':'SWAPPING_HEURISTICS', 
+    'recomputation':'RECOMPUTATION_HEURISTICS'}
+
+# the session config from the command line. intra and inter replace the
+# thread pool sizes, 0 lets tensorflow pick
+def sessionConfig(args, intra=None, inter=None):
+    config = tf.ConfigProto()
+    config.intra_op_parallelism_threads = args.intra_op_threads if intra is None else intra
+    config.inter_op_parallelism_threads = args.inter_op_threads if inter is None else inter
+
+    if args.xla_jit:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    config.graph_options.rewrite_options.memory_optimization = \
+        getattr(rewriter_config_pb2.RewriterConfig, MEMORY_OPTIMIZERS[args.memory_optimizer])
+    return config
+
+# a local variable holding a running total, like the ones tf.metrics keeps.
+# not saved in checkpoints
+def metricVariable(name, shape, dtype):
+    return tf.Variable(tf.zeros(shape, dtype=dtype), trainable=False, name=name, 
+        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
 class Network(object):
-    def __init__(self, args, dataset, checkpoint=None, pretrained=None):
+    def __init__(self, args, dataset, checkpoint=None, pretrained=None, pipeline=None, 
+            allreduce=None):
         self.args = args
         self.dataset = dataset
         self.checkpoint = checkpoint
         self.pretrained = pretrained
+        # tf_pipeline.DatasetPipeline. when set, partialFit(None, epoch) trains
+        # on its next batch without a feed_dict
+        self.pipeline = pipeline
+        # tf_parallel.SharedAllreduce. when set, minimize averages the
+        # gradients over the worker processes
+        self.allreduce = allreduce
+        self.optimizer_variables = []
+        self.gradient_size = 0
 
         self.makePlaceholders()
         self.makeNetwork()
         self.makeCostFunction()
         self.makeOptimizer()
+        self.makeMetrics()
 
         # Initializing the variables
         self.init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
-        self.sess = tf.Session()
+        self.sess = tf.Session(config=sessionConfig(args))
         self.sess.run(self.init)
 
         self.loadWeights()
 
+    # the values of every saved variable, for setSession
+    def variableValues(self):
+        return self.sess.run(self.sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES))
+
+    # replaces the session with one made with config, the saved variables set
+    # to values and the local ones initialized
+    def setSession(self, config, values):
+        graph = self.sess.graph
+        self.sess.close()
+
+        self.sess = tf.Session(graph=graph, config=config)
+        self.sess.run(self.init)
+        self.loadValues(graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES), values)
+
+    # sets variables to values without adding ops to the graph
+    def loadValues(self, variables, values):
+        for variable, value in zip(variables, values):
+            variable.load(value, self.sess)
+
+    # opt.minimize(cost). with an allreduce the gradients are averaged over
+    # the workers before they're applied, so every copy takes the same step
+    def minimize(self, opt, cost):
+        if self.allreduce is None:
+            return opt.minimize(cost)
+
+        pairs = [(grad, var) for grad, var in opt.compute_gradients(cost) if grad is not None]
+        grads = [tf.convert_to_tensor(grad) for grad, var in pairs]
+        averaged = tf.py_func(lambda *values: self.allreduce.average(values), grads, 
+            [grad.dtype for grad in grads], stateful=True)
+        for mean, grad in zip(averaged, grads):
+            mean.set_shape(grad.get_shape())
+        self.gradient_size = sum([int(np.prod(grad.get_shape().as_list())) for grad in grads])
+
+        # the slots and counters the optimizer adds
+        before = set(tf.global_variables())
+        update = opt.apply_gradients(list(zip(averaged, [var for grad, var in pairs])))
+        self.optimizer_variables = [v for v in tf.global_variables() if v not in before]
+        return update
+
+    # a placeholder for element index of a batch. with a pipeline it defaults
+    # to the pipeline's next batch, so only validate and encode have to feed it
+    def makeInput(self, dtype, shape, name, index):
+        if self.pipeline is None:
+            return tf.placeholder(dtype, shape, name=name)
+
+        tensor = tf.cast(self.pipeline.next_batch[index], dtype)
+        tensor = tf.reshape(tensor, [-1] + shape[1:])
+        return tf.placeholder_with_default(tensor, shape, name=name)
+
+    # runs fetches on one batch. data is a batch from the dataset, fed to
+    # inputs, or None to read it from the pipeline. returns the fetched values
+    # and the values of inputs for the batch, unless fetch_inputs is off
+    def runBatch(self, fetches, feed_dict, data, inputs, fetch_inputs=True):
+        if data is None:
+            if not fetch_inputs:
+                return self.sess.run(fetches, feed_dict), None
+            values = self.sess.run(fetches + inputs, feed_dict)
+            return values[:len(fetches)], values[len(fetches):]
+
+        for tensor, value in zip(inputs, data):
+            feed_dict[tensor] = value
+        return self.sess.run(fetches, feed_dict), list(data[:len(inputs)])
+
+    # running training metrics kept in the graph. partialFit runs
+    # metric_update with every batch and readMetrics collects the totals at
+    # the end of the epoch. none by default, the batch results hold everything
+    def makeMetrics(self):
+        self.metric_update = None
+
+    # adds the totals since the last call to an EpochAccumulator and starts
+    # new ones
+    def readMetrics(self, accumulator):
+        if self.metric_update is None:
+            return
+
+        squared_error, elements, confusion = self.sess.run(self.metric_totals)
+        self.sess.run(self.metric_reset)
+
+        # nothing counted when partialFit fetched the reconstructions instead
+        if elements > 0 or confusion.sum() > 0:
+            accumulator.add_totals(squared_error, elements, confusion)
+
     def loadWeights(self):
         print("checkpoint is", self.checkpoint)
         #tensorflow saver.
-        if os.path.exists(self.checkpoint+".index"):
+        # the checkpoint itself or the newest version of it written in the background
+        restorePath = tf_checkpoint.resolve(self.checkpoint)
+        if restorePath is not None:
             # check if resuming previous run
-            print("restoring from previous run")
+            print("restoring from previous run", restorePath)
             self.saver = tf.train.Saver(tf.global_variables())
 
-            self.saver.restore(self.sess, self.checkpoint)
+            self.saver.restore(self.sess, restorePath)
         else:
             # default create saver with all variables.
             self.saver = tf.train.Saver(tf.global_variables())
@@ -241,7 +369,12 @@ class ClassificationAutoencoder__(Network):
         # check to see which chunk we left off on
         trainData = tfd.ChunkGroup(pathFeatures=[args.trainx], 
             pathLabels=args.trainy, batch_size=args.batch_size,
-            preprocessing_fn=os.path.join(args.outputFolder, 'onehot_labelencoder.pkl'))
+            preprocessing_fn=os.path.join(args.outputFolder, 'onehot_labelencoder.pkl'),
+            mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+            columns=featureColumns(args, 0),
+            int_labels=args.int_labels, pk_sampler=args.pk_sampler,
+            global_shuffle=args.global_shuffle, shuffle_buffer=args.shuffle_buffer,
+            batch_buffers=args.batch_buffers)
 
         valData = ClassificationAutoencoder.buildValidationDataset(args)
         return trainData, valData
@@ -250,7 +383,10 @@ class ClassificationAutoencoder__(Network):
     def buildValidationDataset(args):
         valData = tfd.ChunkGroup(pathFeatures=[args.valid], 
             pathLabels=args.validy, batch_size=args.valid_size, shuffle=False,
-            preprocessing_fn=os.path.join(args.outputFolder, 'onehot_labelencoder.pkl'))
+            preprocessing_fn=os.path.join(args.outputFolder, 'onehot_labelencoder.pkl'),
+            mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+            columns=featureColumns(args, 0),
+            int_labels=args.int_labels)
 
         return valData
 
@@ -262,7 +398,10 @@ class ClassificationAutoencoder__(Network):
         for x, y in pairs:
             datasets.append(tfd.ChunkGroup(pathFeatures=[[x]], 
                 pathLabels=[y], batch_size=args.valid_size, shuffle=False,
-                preprocessing_fn=os.path.join(args.outputFolder, 'onehot_labelencoder.pkl')))
+                preprocessing_fn=os.path.join(args.outputFolder, 'onehot_labelencoder.pkl'),
+                mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+                columns=featureColumns(args, 0),
+                int_labels=args.int_labels))
 
         return datasets
 
@@ -272,10 +411,9 @@ class ClassificationAutoencoder__(Network):
 
     def makePlaceholders(self):
         # Placeholders for inputs
-        self.X = tf.placeholder(tf.float32, [None, self.dataset.numFeatures], 
-            name='ph_input_tensor')
-        self.y_true = tf.placeholder(tf.int32, [None, self.dataset.numClasses], 
-            name='ph_y_true')
+        self.X = self.makeInput(tf.float32, [None, self.dataset.numFeatures], 
+            'ph_input_tensor', 0)
+        self.makeLabelPlaceholder()
 
         # drop out
         self.keep_prob = tf.placeholder(tf.float32, name='ph_keep_prob')
@@ -284,13 +422,29 @@ class ClassificationAutoencoder__(Network):
         self.epoch = tf.placeholder(tf.int32, name='ph_epoch')
         self.learning_rate = tf.placeholder(tf.float32, name='ph_learning_rate')
 
+    def makeLabelPlaceholder(self):
+        if self.args.int_labels:
+            # class ids, one hot encoded here instead of by the dataset
+            self.y_true = self.makeInput(tf.int32, [None], 'ph_y_true', 1)
+            self.y_onehot = tf.one_hot(self.y_true, self.dataset.numClasses)
+        else:
+            self.y_true = self.makeInput(tf.int32, [None, self.dataset.numClasses], 
+                'ph_y_true', 1)
+            self.y_onehot = self.y_true
+
+    def makeClassPrediction(self):
+        indicies = tf.argmax(tf.nn.softmax(self.logits), axis=1)
+        if self.args.int_labels:
+            self.class_prediction = tf.cast(indicies, tf.int32)
+        else:
+            self.class_prediction = tf.one_hot(indicies, self.dataset.numClasses)
+
     def makeNetwork(self):
         self.encoded = self.encoder()
         self.y_pred = self.decoder()
 
         self.logits = tf.layers.dense(self.encoded, self.dataset.numClasses)
-        indicies = tf.argmax(tf.nn.softmax(self.logits), axis=1)
-        self.class_prediction = tf.one_hot(indicies, self.dataset.numClasses)
+        self.makeClassPrediction()
 
     def makeCostFunction(self):
         # Targets (Labels) are the input data.
@@ -298,7 +452,7 @@ class ClassificationAutoencoder__(Network):
         self.reconstructionError = tf.sqrt(tf.reduce_mean(tf.pow(self.X - self.y_pred, 2)))
         self.cross_entropy_loss = tf.reduce_mean(
             tf.nn.softmax_cross_entropy_with_logits_v2(
-            logits=self.logits, labels=self.y_true))
+            logits=self.logits, labels=self.y_onehot))
 
         self.cost = (1-self.args.center_loss_alpha)*self.reconstructionError + \
             self.args.center_loss_alpha*self.cross_entropy_loss
@@ -310,19 +464,50 @@ class ClassificationAutoencoder__(Network):
 
         #opt = tf.train.GradientDescentOptimizer(self.learning_rate)
         opt = tf.train.AdamOptimizer(self.learning_rate)
-        self.optimizer = opt.minimize(self.cost)
+        self.optimizer = self.minimize(opt, self.cost)
+
+    # squared reconstruction error and a confusion matrix over class ids,
+    # summed over the batches of the epoch
+    def makeMetrics(self):
+        numClasses = self.dataset.numClasses
+        with tf.name_scope('training_metrics'):
+            squared_error = metricVariable('squared_error', [], tf.float64)
+            elements = metricVariable('elements', [], tf.int64)
+            confusion = metricVariable('confusion', [numClasses, numClasses], tf.int64)
+
+            diff = tf.cast(self.X - self.y_pred, tf.float64)
+            if self.args.int_labels:
+                true_ids = self.y_true
+            else:
+                true_ids = tf.argmax(self.y_true, axis=1)
+            pred_ids = tf.argmax(self.logits, axis=1)
+
+            self.metric_update = tf.group(
+                tf.assign_add(squared_error, tf.reduce_sum(diff * diff)),
+                tf.assign_add(elements, tf.size(diff, out_type=tf.int64)),
+                tf.assign_add(confusion, tf.confusion_matrix(true_ids, pred_ids, 
+                    num_classes=numClasses, dtype=tf.int64)))
+
+        self.metric_totals = [squared_error, elements, confusion]
+        self.metric_reset = tf.variables_initializer(self.metric_totals)
 
     def partialFit(self, data, epoch):
-        X, y, loop = data
-        feed_dict={self.X : X, self.epoch : epoch, \
+        feed_dict={self.epoch : epoch, \
                     self.keep_prob : self.args.keep_prob, \
-                    self.learning_rate : self.args.learning_rate, \
-                    self.y_true : y}
+                    self.learning_rate : self.args.learning_rate}
 
         start = timeit.default_timer()
-        cost, y_pred, class_pred, opt, = self.sess.run([self.cost, \
+        if not self.args.fetch_reconstructions:
+            # only the cost leaves the runtime, the rest goes to the metrics
+            [cost, update, opt], inputs = self.runBatch([self.cost, \
+                            self.metric_update, self.optimizer \
+                            ], feed_dict, data, [self.X, self.y_true], fetch_inputs=False)
+
+            return timeit.default_timer()-start, BatchCostResults(cost=cost)
+
+        [cost, y_pred, class_pred, opt], [X, y] = self.runBatch([self.cost, \
                         self.y_pred, self.class_prediction, self.optimizer \
-                        ], feed_dict)
+                        ], feed_dict, data, [self.X, self.y_true])
 
         return timeit.default_timer()-start, \
             ClassificationAutoencoderResults(X=X, y=self.dataset.inverse_transform(y), 
@@ -380,12 +565,12 @@ class CenterLossAutoencoder__(ClassificationAutoencoder__):
         # center loss stuff
         # calculate binary labels for center_loss, must be in one_hot encoding
         self.center_loss, centers, self.centers_update_op = \
-            calc_center_loss(self.encoded, self.y_true, self.args.center_loss_alpha)
+            calc_center_loss(self.encoded, self.y_onehot, self.args.center_loss_alpha)
 
         self.reconstruction_error = tf.sqrt(tf.reduce_mean(tf.pow(self.X - self.y_pred, 2)))
         self.cross_entropy_loss = tf.reduce_mean(
             tf.nn.softmax_cross_entropy_with_logits_v2(
-            logits=self.logits, labels=self.y_true))
+            logits=self.logits, labels=self.y_onehot))
 
         lambdas = np.array(self.args.center_loss_lambdas)
         normed_lambdas = lambdas / np.sum(lambdas)
@@ -404,23 +589,31 @@ class CenterLossAutoencoder__(ClassificationAutoencoder__):
 
         #opt = tf.train.GradientDescentOptimizer(self.learning_rate)
         opt = tf.train.AdamOptimizer(self.learning_rate)
-        self.optimizer = opt.minimize(self.cost)
+        self.optimizer = self.minimize(opt, self.cost)
 
     def partialFit(self, data, epoch):
-        X, y, loop = data
-        feed_dict={self.X : X, self.epoch : epoch, \
+        feed_dict={self.epoch : epoch, \
                     self.keep_prob : self.args.keep_prob, \
-                    self.learning_rate : self.args.learning_rate, \
-                    self.y_true : y}
+                    self.learning_rate : self.args.learning_rate}
 
         start = timeit.default_timer()
-        cost, pred_X, class_pred, \
+        if not self.args.fetch_reconstructions:
+            [cost, center_loss, \
+            update, cuop, op], inputs = self.runBatch([self.cost, \
+                self.center_loss, self.metric_update, \
+                self.centers_update_op, self.optimizer \
+                ], feed_dict, data, [self.X, self.y_true], fetch_inputs=False)
+
+            return timeit.default_timer()-start, \
+                BatchCostResults(cost=cost, center_loss=center_loss)
+
+        [cost, pred_X, class_pred, \
         center_loss, \
-        cuop, op = self.sess.run([self.cost, \
+        cuop, op], [X, y] = self.runBatch([self.cost, \
             self.y_pred, self.class_prediction, \
             self.center_loss,
             self.centers_update_op, self.optimizer \
-            ], feed_dict)
+            ], feed_dict, data, [self.X, self.y_true])
 
         return timeit.default_timer()-start, \
             CenterLossAEResults(X=X, y=self.dataset.inverse_transform(y), 
@@ -465,7 +658,7 @@ class TumorAE__(ClassificationAutoencoder__):
 
     def makePlaceholders(self):
         # Placeholders for inputs
-        self.X = tf.placeholder(tf.float32, [None, self.dataset.numFeatures], name='ph_input_tensor')
+        self.X = self.makeInput(tf.float32, [None, self.dataset.numFeatures], 'ph_input_tensor', 0)
 
         # drop out
         self.keep_prob = tf.placeholder(tf.float32, name='ph_keep_prob')
@@ -478,20 +671,23 @@ class TumorAE__(ClassificationAutoencoder__):
         self.encoded = self.encoder()
         self.y_pred = self.decoder()
 
+    # partialFit returns the batch results
+    def makeMetrics(self):
+        Network.makeMetrics(self)
+
     def makeCostFunction(self):
         self.reconstructionError = tf.sqrt(tf.reduce_mean(tf.pow(self.X - self.y_pred, 2)))
         self.cost = self.reconstructionError
 
     def partialFit(self, data, epoch):
-        X, y, loop = data
-        feed_dict={self.X : X, self.epoch : epoch, \
+        feed_dict={self.epoch : epoch, \
                     self.keep_prob : self.args.keep_prob, \
                     self.learning_rate : self.args.learning_rate}
 
         start = timeit.default_timer()
-        cost, opt, = self.sess.run([self.cost, \
+        [cost, opt], inputs = self.runBatch([self.cost, \
                         self.optimizer \
-                        ], feed_dict)
+                        ], feed_dict, data, [self.X])
 
         return timeit.default_timer()-start, \
             AEResults(cost=cost)
@@ -540,9 +736,9 @@ class TumorClassifier__(ClassificationAutoencoder):
 
     def makePlaceholders(self):
         # Placeholders for inputs
-        self.X = tf.placeholder(tf.float32, [None, self.dataset.numFeatures], name='ph_input_tensor')
-        # input and output labels are in one_hot encoding
-        self.y_true = tf.placeholder(tf.int32, [None, self.dataset.numClasses], name='ph_y_true')
+        self.X = self.makeInput(tf.float32, [None, self.dataset.numFeatures], 'ph_input_tensor', 0)
+        # input and output labels are in one_hot encoding, or class ids with int_labels
+        self.makeLabelPlaceholder()
 
         # drop out
         self.keep_prob = tf.placeholder(tf.float32, name='ph_keep_prob')
@@ -555,27 +751,28 @@ class TumorClassifier__(ClassificationAutoencoder):
         self.encoded = self.encoder()
 
         self.logits = tf.layers.dense(self.encoded, self.dataset.numClasses)
-        indicies = tf.argmax(tf.nn.softmax(self.logits), axis=1)
-        self.class_prediction = tf.one_hot(indicies, self.dataset.numClasses)
+        self.makeClassPrediction()
+
+    # partialFit returns the batch results
+    def makeMetrics(self):
+        Network.makeMetrics(self)
 
     def makeCostFunction(self):
         # Targets (Labels) are the input data.
         # Define loss and optimizer, minimize the squared error
         self.cross_entropy_loss = tf.nn.softmax_cross_entropy_with_logits_v2(
-            logits=self.logits, labels=self.y_true)
+            logits=self.logits, labels=self.y_onehot)
         self.cost = tf.reduce_mean(self.cross_entropy_loss)
 
     def partialFit(self, data, epoch):
-        X, y, loop = data
-        feed_dict={self.X : X, self.epoch : epoch, \
+        feed_dict={self.epoch : epoch, \
                     self.keep_prob : self.args.keep_prob, \
-                    self.learning_rate : self.args.learning_rate, \
-                    self.y_true : y}
+                    self.learning_rate : self.args.learning_rate}
 
         start = timeit.default_timer()
-        cost, class_pred, opt, = self.sess.run([self.cost, \
+        [cost, class_pred, opt], [X, y] = self.runBatch([self.cost, \
                         self.class_prediction, self.optimizer \
-                        ], feed_dict)
+                        ], feed_dict, data, [self.X, self.y_true])
 
         return timeit.default_timer()-start, \
             ClassifierResults(y=self.dataset.inverse_transform(y), 
@@ -619,7 +816,12 @@ class DosageDrugRegression(Network):
         # check to see which chunk we left off on
         trainData = tfd.ChunkGroup(pathFeatures=[args.trainx, args.trainz, args.traind], 
             pathLabels=args.trainy, batch_size=args.batch_size, 
-            preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'))
+            preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'),
+            mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+            columns=featureColumns(args, 1),
+            tables=[args.drug_table, args.cell_table],
+            global_shuffle=args.global_shuffle, shuffle_buffer=args.shuffle_buffer,
+            batch_buffers=args.batch_buffers)
 
         valData = DosageDrugRegression.buildValidationDataset(args)
         return trainData, valData
@@ -629,12 +831,18 @@ class DosageDrugRegression(Network):
         if type(args.valid) == type([]):
             valData = tfd.ChunkGroup(pathFeatures=[args.valid, args.validz, args.validd], 
                 pathLabels=args.validy, batch_size=args.valid_size, shuffle=False, 
-                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'))
+                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'),
+                mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+                columns=featureColumns(args, 1),
+                tables=[args.drug_table, args.cell_table])
         elif type(args.valid) == type(''):
             valData = tfd.ChunkGroup(
                 pathFeatures=[[args.valid], [args.validz], [args.validd]], 
                 pathLabels=[args.validy], batch_size=args.valid_size, 
-                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'))
+                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'),
+                mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+                columns=featureColumns(args, 1),
+                tables=[args.drug_table, args.cell_table])
         else:
             print("unrecognized input type", type(args.valid))
             valData = None
@@ -650,7 +858,10 @@ class DosageDrugRegression(Network):
         for x, z, d, y in pairs:
             datasets.append(tfd.ChunkGroup(pathFeatures=[[x], [z], [d]], 
                 pathLabels=[y], batch_size=args.valid_size, shuffle=False,
-                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl')))
+                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'),
+                mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+                columns=featureColumns(args, 1),
+                tables=[args.drug_table, args.cell_table]))
 
         return datasets
 
@@ -665,7 +876,7 @@ class DosageDrugRegression(Network):
 
         #opt = tf.train.GradientDescentOptimizer(self.learning_rate)
         opt = tf.train.AdamOptimizer(self.learning_rate)
-        self.optimizer = opt.minimize(self.cost)
+        self.optimizer = self.minimize(opt, self.cost)
 
         #for grad, var in opt.compute_gradients(self.cost):
         #    if grad is not None:
@@ -674,19 +885,19 @@ class DosageDrugRegression(Network):
         #        #pass
 
     def makePlaceholders(self):
-        self.drug_X = tf.placeholder(tf.float32, 
-            [None, self.dataset.features[0].numFeatures], name='ph_input_drugs')
-        self.rnaseq_X = tf.placeholder(tf.float32, 
-            [None, self.dataset.features[1].numFeatures], name='ph_input_rnaseq')
-        self.dose_X = tf.placeholder(tf.float32, 
-            [None, 1], name='ph_input_dose')
+        self.drug_X = self.makeInput(tf.float32, 
+            [None, self.dataset.features[0].numFeatures], 'ph_input_drugs', 0)
+        self.rnaseq_X = self.makeInput(tf.float32, 
+            [None, self.dataset.features[1].numFeatures], 'ph_input_rnaseq', 1)
+        self.dose_X = self.makeInput(tf.float32, 
+            [None, 1], 'ph_input_dose', 2)
 
         self.learning_rate = tf.placeholder(tf.float32, name='ph_learning_rate')
         self.keep_prob = tf.placeholder(tf.float32, name='ph_keep_prob')
         self.epoch = tf.placeholder(tf.int32, name='ph_epoch')
 
-        self.y_true = tf.placeholder(tf.float32, [None, 1], 
-            name='ph_y_true')
+        self.y_true = self.makeInput(tf.float32, [None, 1], 
+            'ph_y_true', 3)
 
     def makeNetwork(self):
         self.drug_ae = getNetwork(self.args.drug_type)()
@@ -738,21 +949,21 @@ class DosageDrugRegression(Network):
             #tf.summary.scalar('weight decay', self.cost - self.rms_error)
 
     def partialFit(self, data, epoch):
-        X, Z, D, y, loop = data
-        D = D.reshape((D.shape[0],1))
-        y = y.reshape((y.shape[0],1))
+        if data is not None:
+            X, Z, D, y, loop = data
+            D = D.reshape((D.shape[0],1))
+            y = y.reshape((y.shape[0],1))
+            data = (X, Z, D, y)
 
         start = timeit.default_timer()
-        feed_dict={self.drug_X : X, self.rnaseq_X: Z, self.dose_X: D,
-                    self.epoch : epoch, \
+        feed_dict={self.epoch : epoch, \
                     self.keep_prob : self.args.keep_prob, \
-                    self.learning_rate : self.args.learning_rate, \
-                    self.y_true : y}
+                    self.learning_rate : self.args.learning_rate}
 
         # necessary to run
-        [cost, regression, opt] = self.sess.run([ \
+        [cost, regression, opt], [X, Z, D, y] = self.runBatch([ \
                 self.cost, self.y_pred, self.optimizer, 
-            ], feed_dict)
+            ], feed_dict, data, [self.drug_X, self.rnaseq_X, self.dose_X, self.y_true])
 
         return timeit.default_timer()-start, RSquaredResults(Y=y, cost=cost, P=regression)
 
@@ -804,7 +1015,12 @@ class AUCRegression(Network):
         # check to see which chunk we left off on
         trainData = tfd.KeyedChunkGroup(pathFeatures=[args.trainx, args.trainz], 
             pathLabels=args.trainy, batch_size=args.batch_size, 
-            preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'))
+            preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'),
+            mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+            columns=featureColumns(args, 1),
+            tables=[args.drug_table, args.cell_table],
+            global_shuffle=args.global_shuffle, shuffle_buffer=args.shuffle_buffer,
+            batch_buffers=args.batch_buffers)
 
         valData = AUCRegression.buildValidationDataset(args)
 
@@ -815,11 +1031,17 @@ class AUCRegression(Network):
         if type(args.valid) == type([]):
             valData = tfd.KeyedChunkGroup(pathFeatures=[args.valid, args.validz], 
                 pathLabels=args.validy, batch_size=args.valid_size, shuffle=False, 
-                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'))
+                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'),
+                mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+                columns=featureColumns(args, 1),
+                tables=[args.drug_table, args.cell_table])
         elif type(args.valid) == type(''):
             valData = tfd.KeyedChunkGroup(pathFeatures=[[args.valid], [args.validz]], 
                 pathLabels=[args.validy], batch_size=args.valid_size,
-                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'))
+                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'),
+                mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+                columns=featureColumns(args, 1),
+                tables=[args.drug_table, args.cell_table])
         else:
             print("unrecognized input type", type(args.valid))
             valData = None
@@ -835,7 +1057,10 @@ class AUCRegression(Network):
         for x, z, y in pairs:
             datasets.append(tfd.ChunkGroup(pathFeatures=[[x], [z]], 
                 pathLabels=[y], batch_size=args.valid_size, shuffle=False,
-                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl')))
+                preprocessing_fn=os.path.join(args.outputFolder, 'no_preprocessor.pkl'),
+                mmap=args.mmap, preload=args.preload_chunks, dtype=args.dtype,
+                columns=featureColumns(args, 1),
+                tables=[args.drug_table, args.cell_table]))
 
         return datasets
 
@@ -844,17 +1069,17 @@ class AUCRegression(Network):
         return tf_log.RegressionLog
 
     def makePlaceholders(self):
-        self.drug_X = tf.placeholder(tf.float32, 
-            [None, self.dataset.features[0].numFeatures], name='ph_input_drugs')
-        self.rnaseq_X = tf.placeholder(tf.float32, 
-            [None, self.dataset.features[1].numFeatures], name='ph_input_rnaseq')
+        self.drug_X = self.makeInput(tf.float32, 
+            [None, self.dataset.features[0].numFeatures], 'ph_input_drugs', 0)
+        self.rnaseq_X = self.makeInput(tf.float32, 
+            [None, self.dataset.features[1].numFeatures], 'ph_input_rnaseq', 1)
 
         self.learning_rate = tf.placeholder(tf.float32, name='ph_learning_rate')
         self.keep_prob = tf.placeholder(tf.float32, name='ph_keep_prob')
         self.epoch = tf.placeholder(tf.int32, name='ph_epoch')
 
-        self.auc_true = tf.placeholder(tf.float32, [None, 1], 
-            name='ph_auc_true')
+        self.auc_true = self.makeInput(tf.float32, [None, 1], 
+            'ph_auc_true', 2)
 
     def makeOptimizer(self):
         #decayedLearn = tf.train.exponential_decay(self.learning_rate, \
@@ -862,7 +1087,7 @@ class AUCRegression(Network):
 
         #opt = tf.train.GradientDescentOptimizer(self.learning_rate)
         opt = tf.train.AdamOptimizer(self.learning_rate)
-        self.optimizer = opt.minimize(self.cost)
+        self.optimizer = self.minimize(opt, self.cost)
 
     def makeNetwork(self):
         self.drug_branch = getNetwork(self.args.drug_type)()
@@ -911,19 +1136,20 @@ class AUCRegression(Network):
             self.cost = tf.add_n(losses_collection)
 
     def partialFit(self, data, epoch):
-        X, Z, y, loop = data
-        y = y.reshape((y.shape[0],1))
+        if data is not None:
+            X, Z, y, loop = data
+            y = y.reshape((y.shape[0],1))
+            data = (X, Z, y)
 
-        feed_dict={self.drug_X : X, self.rnaseq_X: Z,
-                    self.epoch : epoch, \
+        feed_dict={self.epoch : epoch, \
                     self.keep_prob : self.args.keep_prob, \
-                    self.learning_rate : self.args.learning_rate, \
-                    self.auc_true : y}
+                    self.learning_rate : self.args.learning_rate}
 
         start = timeit.default_timer()
         # necessary to run
-        [cost, regression, opt] = self.sess.run([ \
-                self.cost, self.auc_pred, self.optimizer], feed_dict)
+        [cost, regression, opt], [X, Z, y] = self.runBatch([ \
+                self.cost, self.auc_pred, self.optimizer], feed_dict, data, \
+                [self.drug_X, self.rnaseq_X, self.auc_true])
 
         return timeit.default_timer()-start, RSquaredResults(Y=y, cost=cost, P=regression)
 
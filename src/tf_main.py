@@ -19,11 +19,15 @@ import sys
 #import matplotlib.pyplot as plt
 
 from scipy import misc
+import tf_dataset as tfd
 from tf_dataset import VariableSet
 
-from tf_validationInfo import RSquaredResults
+from tf_validationInfo import RSquaredResults, EpochAccumulator
 from tf_graph import *
 import tf_encode
+import tf_pipeline
+import tf_checkpoint
+import tf_parallel
 from tf_MNIST import MNIST, MNIST_val
 import tf_log
 
@@ -33,6 +37,7 @@ from sklearn.metrics import accuracy_score, f1_score, \
 
 import argparse
 import timeit
+import multiprocessing
 import time
 
 from sklearn.preprocessing import StandardScaler
@@ -69,6 +74,10 @@ def parseArgs():
     parser.add_argument('-vz', '--validz', nargs='+', default=[''], action='store', help='secondary validation feature samples')
     parser.add_argument('-vd', '--validd', nargs='+', default=[''], action='store', help='tertiary validation feature samples')
     parser.add_argument('-vy', '--validy', nargs='+', default=[''], action='store', help='path to validation labels')
+    parser.add_argument('--drug_table', default='', action='store', help='lookup table of unique drug feature vectors. the X and vX chunks then hold row ids into it')
+    parser.add_argument('--cell_table', default='', action='store', help='lookup table of unique cell line feature vectors. the Z and vZ chunks then hold row ids into it')
+    parser.add_argument('--feature_columns', default='', action='store', help='file with the expression columns to use, one column index or gene name per line. only those columns are read from the chunks')
+    parser.add_argument('--feature_header', default='', action='store', help='gene name of every expression column, one per line. needed when --feature_columns lists gene names')
 
     parser.add_argument('-o', '--outputFolder', default='', action='store', help='path to output folder')
     parser.add_argument('-s', '--summaryFolder', default='', action='store', help='path to output folder for summaries')
@@ -95,6 +104,32 @@ def parseArgs():
     parser.add_argument('--dist_weight', type=float, default=0., help='weight for cost function that measures "distance from the line"')
     parser.add_argument('--keep_mask_loops', type=int, default=1, help='number of validation loops with different dropout masks')
     parser.add_argument('--prediction_suffix', type=str, default="_pred", help="the suffix appended to the end of prediction output names")
+    parser.add_argument('--mmap', action='store_true', default=False, help='memory map .npy chunks instead of loading them into RAM')
+    parser.add_argument('--prefetch_depth', type=int, default=0, help='number of training batches assembled ahead on a background thread. 0 disables prefetching')
+    parser.add_argument('--batch_workers', type=int, default=0, help='number of worker processes assembling training batches into shared memory. 0 assembles them in the training process')
+    parser.add_argument('--worker_depth', type=int, default=4, help='shared memory batch slots per batch worker')
+    parser.add_argument('--num_workers', type=int, default=1, help='train data parallel in this many processes, each on a shard of the training chunks, averaging the gradients of every step. checkpoints and logs come from the first one')
+    parser.add_argument('--intra_op_threads', type=int, default=0, help='threads running a single op, like a matmul. 0 lets tensorflow pick')
+    parser.add_argument('--inter_op_threads', type=int, default=0, help='threads running independent ops at the same time. 0 lets tensorflow pick')
+    parser.add_argument('--xla_jit', action='store_true', default=False, help='compile the graph with the XLA JIT')
+    parser.add_argument('--memory_optimizer', default='default', choices=sorted(MEMORY_OPTIMIZERS.keys()), help='grappler memory optimizer: default, off, or the rewrite it runs')
+    parser.add_argument('--autotune_session', type=int, default=0, help='time this many training steps with a few thread pool sizes before training and keep the fastest. 0 uses --intra_op_threads and --inter_op_threads')
+    parser.add_argument('--async_checkpoint', action='store_true', default=False, help='write checkpoints from a snapshot of the variables on a background thread, as numbered versions of the checkpoint name')
+    parser.add_argument('--keep_last', type=int, default=1, help='with --async_checkpoint, versions of the training checkpoint to keep')
+    parser.add_argument('--keep_best', type=int, default=1, help='with --async_checkpoint, versions of the ratchet checkpoint to keep, the ones with the lowest validation cost')
+    parser.add_argument('--checkpoint_steps', type=int, default=0, help='also save the checkpoint and the dataset position every this many batches, so a restarted run resumes at the same batch. 0 only saves at the end of each epoch')
+    parser.add_argument('--global_shuffle', action='store_true', default=False, help='shuffle the chunk order every epoch and mix samples across chunks')
+    parser.add_argument('--shuffle_buffer', type=int, default=10000, help='number of samples held for mixing across chunks with --global_shuffle')
+    parser.add_argument('--pk_sampler', type=int, nargs=2, default=None, metavar=('P', 'K'), help='build every training batch from P classes with K samples each, instead of batch_size samples in file order. classification models only')
+    parser.add_argument('--batch_buffers', type=int, default=0, help='recycle this many preallocated arrays for training batches. a batch is only valid until that many more are read. 0 allocates new arrays')
+    parser.add_argument('--preload_chunks', action='store_true', default=False, help='read the next chunk on a background thread while the current one is used. holds two chunks in memory')
+    parser.add_argument('--dtype', default='float32', choices=['float16', 'float32', 'float64'], help='storage dtype for feature chunks. float16 halves memory again and is upcast to float32 per batch')
+    parser.add_argument('--int_labels', action='store_true', default=False, help='feed class labels as int32 ids and one hot encode them in the graph instead of in the dataset')
+    parser.add_argument('--fetch_reconstructions', action='store_true', default=False, help='fetch the reconstructions and class predictions of every training batch and score them on the host, instead of keeping the training metrics in the graph')
+    parser.add_argument('--tf_data', action='store_true', default=False, help='train from a tf.data pipeline instead of feed_dict')
+    parser.add_argument('--tf_data_threads', type=int, default=4, help='parallel calls for the tf.data map')
+    parser.add_argument('--tf_data_prefetch', type=int, default=2, help='batches prefetched by the tf.data pipeline')
+    parser.add_argument('--tf_data_cache', default='', help='cache the first epoch of the tf.data pipeline in this file. later epochs replay it in the same order')
     parser.add_argument('-CUDA_VISIBLE_DEVICES', type=str, default='', help='CUDA_VISIBLE_DEVICES')
 
     args = parser.parse_args()
@@ -153,8 +188,116 @@ def set_cuda_visible_devices(args):
     if len(args.CUDA_VISIBLE_DEVICES) > 0:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.CUDA_VISIBLE_DEVICES
 
-def trainModels(args):
+# thread pool sizes tried by autotuneSession, (intra, inter)
+def sessionCandidates():
+    cores = multiprocessing.cpu_count()
+    intra = sorted(set([cores, max(cores//2, 1), max(cores//4, 1)]), reverse=True)
+    return [(i, j) for i in intra for j in [1, 2]]
+
+# times args.autotune_session training steps on the first batches of the
+# epoch with every candidate session and keeps the fastest. the steps only
+# measure, the weights and the dataset go back to where they were
+def autotuneSession(args, opGraph, trainData, timing_log):
+    # batch workers can't go back to a position, their batches come from a
+    # separate pass over the group in this process
+    if isinstance(trainData, tfd.ProcessChunkGroup):
+        state = None
+        next_batch = trainData.get_onetime_batch
+    else:
+        state = trainData.get_state()
+        next_batch = trainData.get_next_batch
+
+    # one extra batch warms up every session. batches can be recycled
+    # buffers, so they're copied
+    batches = []
+    loop = False
+    while len(batches) < args.autotune_session + 1 and not loop:
+        data = next_batch()
+        loop = data[-1]
+        batches.append([np.array(d) if isinstance(d, np.ndarray) else d for d in data])
+    if state is not None:
+        trainData.set_state(state)
+
+    values = opGraph.variableValues()
+    best = None
+    for intra, inter in sessionCandidates():
+        opGraph.setSession(sessionConfig(args, intra, inter), values)
+        opGraph.partialFit(batches[0], 0)
+        times = [opGraph.partialFit(data, 0)[0] for data in batches[1:]]
+        step_time = np.mean(times) if times else 0.
+
+        timing_log.log("autotune intra %d inter %d: %.4f per step" % (intra, inter, step_time))
+        if best is None or step_time < best[0]:
+            best = (step_time, intra, inter)
+
+    step_time, intra, inter = best
+    timing_log.log("autotune picked intra %d inter %d" % (intra, inter))
+    opGraph.setSession(sessionConfig(args, intra, inter), values)
+
+# saves the weights, through the background writer when there is one. with
+# a cost the checkpoint only stays among the writer's keep_best lowest costs
+def saveCheckpoint(opGraph, writer, checkpointPath, cost=None, after=None):
+    if writer is None:
+        opGraph.saver.save(opGraph.sess, checkpointPath)
+        if after is not None:
+            after()
+    else:
+        writer.save(checkpointPath, cost=cost, after=after)
+
+# saves the weights, then the epoch and the iterator position, so a
+# restarted run continues after the batch that was just trained on
+def saveProgress(opGraph, writer, checkpointPath, epoch_idx_filename, epoch, batches, state):
+    def writeProgress():
+        with open(epoch_idx_filename, 'w') as save:
+            save.write(str(epoch))
+        tfd.save_iterator_state(checkpointPath + '.iterator', 
+            {'epoch':epoch, 'batches':batches, 'state':state})
+
+    saveCheckpoint(opGraph, writer, checkpointPath, after=writeProgress)
+
+# writes which chunk column, and gene, every input column came from
+def saveFeatureColumns(args):
+    if args.feature_columns:
+        columns, names = tfd.select_columns(args.feature_columns, args.feature_header)
+        tfd.write_feature_columns(os.path.join(args.outputFolder, 'feature_columns.txt'), columns, names)
+
+# comm: tf_parallel.SharedAllreduce when running as one of --num_workers
+def trainModels(args, comm=None):
+    if args.checkpoint_steps > 0 and args.batch_workers > 0:
+        raise ValueError("--checkpoint_steps can't save the position of --batch_workers")
+    if args.pk_sampler is not None and not issubclass(getOp(args), ClassificationAutoencoder__):
+        raise ValueError("--pk_sampler only works with classification models, not %s" % args.graph_type)
+    if comm is not None:
+        # every worker has to take the same number of steps, in its own shard
+        if args.batch_workers > 0 or args.tf_data or args.checkpoint_steps > 0 or \
+                args.autotune_session > 0:
+            raise ValueError("--num_workers can't be combined with --batch_workers, --tf_data, "
+                "--checkpoint_steps or --autotune_session")
+        if args.intra_op_threads == 0:
+            # the workers share the cores
+            args.intra_op_threads = max(multiprocessing.cpu_count() // comm.size, 1)
+
+    # only the first worker writes checkpoints and logs
+    chief = comm is None or comm.rank == 0
+
+    # the chief writes the preprocessing files, the others load them once
+    # it's done
+    if comm is not None and not chief:
+        comm.barrier.wait()
     trainData, valData = buildDatasets(args)
+    if comm is not None and chief:
+        comm.barrier.wait()
+    if comm is not None:
+        # the workers step together, so the shards have to be the same size
+        trainData.shard(comm.rank, comm.size, seed=comm.seed, even=True)
+    if chief:
+        saveFeatureColumns(args)
+    if args.batch_workers > 0:
+        # batches are only views into shared memory when batch_buffers allows it
+        trainData = tfd.ProcessChunkGroup(trainData, workers=args.batch_workers, 
+            depth=args.worker_depth, copy=args.batch_buffers == 0)
+    elif args.prefetch_depth > 0:
+        trainData = tfd.PrefetchChunkGroup(trainData, depth=args.prefetch_depth)
 
     bestPerf = None
     set_cuda_visible_devices(args)
@@ -170,10 +313,38 @@ def trainModels(args):
         g_Output_CheckpointPath = os.path.join(args.outputFolder, args.out_check_name)
         ratchetCheckpoint = g_Output_CheckpointPath + "_ratchet"
 
+        # training batches can reach the graph through tf.data instead of feed_dict
+        pipeline = None
+        if args.tf_data:
+            pipeline = tf_pipeline.DatasetPipeline(trainData, map_threads=args.tf_data_threads, 
+                prefetch=args.tf_data_prefetch, 
+                cache=os.path.join(args.outputFolder, args.tf_data_cache) if args.tf_data_cache else '')
+
         # infer model type based on presence of labeled data
         model = getOp(args)
         opGraph = model(args, trainData, 
-            checkpoint=g_Output_CheckpointPath, pretrained=pretrained)
+            checkpoint=g_Output_CheckpointPath, pretrained=pretrained, pipeline=pipeline, 
+            allreduce=comm)
+        if comm is not None:
+            # every worker starts from the first one's weights
+            tf_parallel.setup(comm, opGraph)
+
+        # setup log, the other workers' go nowhere
+        if not chief:
+            log = model.getPreferedLogger()(os.devnull)
+            timing_log = tf_log.String_Log(os.devnull)
+        else:
+            log = model.getPreferedLogger()(os.path.join(args.outputFolder, 'training.log'))
+            timing_log = tf_log.String_Log(os.path.join(args.outputFolder, 'timing.log'))
+
+        if args.autotune_session > 0:
+            autotuneSession(args, opGraph, trainData, timing_log)
+
+        # checkpoints written in the background, from a copy of the variables
+        writer = None
+        if args.async_checkpoint and chief:
+            writer = tf_checkpoint.CheckpointWriter(opGraph.sess, tf.global_variables(), 
+                keep_last=args.keep_last, keep_best=args.keep_best)
 
         # load training index from file if it exists
         epoch_idx_filename = os.path.join(args.outputFolder, "epoch_index.sav")
@@ -183,46 +354,116 @@ def trainModels(args):
         else:
             start_epoch = 0
 
+        # continue a preempted epoch from the saved iterator position
+        start_batch = 0
+        if args.checkpoint_steps > 0:
+            if isinstance(trainData, tfd.PrefetchChunkGroup):
+                trainData.state_steps = args.checkpoint_steps
+            if pipeline is not None:
+                pipeline.state_steps = args.checkpoint_steps
+
+            progress = tfd.load_iterator_state(g_Output_CheckpointPath + '.iterator')
+            if progress is not None and progress['epoch'] == start_epoch:
+                print("resuming epoch", start_epoch, "after batch", progress['batches'])
+                trainData.set_state(progress['state'])
+                start_batch = progress['batches']
+
+                # the states are recorded by the batch number in the epoch
+                if isinstance(trainData, tfd.PrefetchChunkGroup):
+                    trainData.state_offset = start_batch
+                if pipeline is not None:
+                    pipeline.state_offset = start_batch
+
         # save variables that are trainable in case we're pretraining
         trainableVariables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
-        VariableSet.writeFile(trainableVariables, g_Output_CheckpointPath)
-
-        # set up summary paths
-        trainPath, valPath = makeSummaryDirectories(args)
-
-        # setup log
-        log = model.getPreferedLogger()(os.path.join(args.outputFolder, 'training.log'))
-        timing_log = tf_log.String_Log(os.path.join(args.outputFolder, 'timing.log'))
+        if chief:
+            VariableSet.writeFile(trainableVariables, g_Output_CheckpointPath)
+
+            # set up summary paths
+            trainPath, valPath = makeSummaryDirectories(args)
+
+        timing_log.log("memory mapped chunks %s" % args.mmap)
+        timing_log.log("prefetch depth %d" % args.prefetch_depth)
+        timing_log.log("batch workers %d" % args.batch_workers)
+        timing_log.log("preload chunks %s" % args.preload_chunks)
+        timing_log.log("feature dtype %s" % args.dtype)
+        timing_log.log("int labels %s" % args.int_labels)
+        timing_log.log("tf.data input %s" % args.tf_data)
+        timing_log.log("checkpoint steps %d" % args.checkpoint_steps)
+        timing_log.log("P x K sampler %s" % (args.pk_sampler,))
+        timing_log.log("fetch reconstructions %s" % args.fetch_reconstructions)
+        timing_log.log("session threads intra %d inter %d, xla jit %s, memory optimizer %s" % 
+            (args.intra_op_threads, args.inter_op_threads, args.xla_jit, args.memory_optimizer))
+        timing_log.log("workers %d" % args.num_workers)
+        timing_log.log("async checkpoint %s, keep last %d, keep best %d" % 
+            (args.async_checkpoint, args.keep_last, args.keep_best))
 
         # Training cycle
         for epoch in range(start_epoch, args.epoch_count):
             # Loop over all batches
             start = timeit.default_timer()
             print("epoch", epoch)
-            results = []
+            epoch_metrics = EpochAccumulator()
             loop = False
             net_times = []
             read_times = []
+            batches = start_batch if epoch == start_epoch else 0
+            if pipeline is not None:
+                opGraph.sess.run(pipeline.initializer)
             while not loop:
-                read_start = timeit.default_timer()
-                data = trainData.get_next_batch()
-                read_times.append(timeit.default_timer()-read_start)
-
-                loop = data[-1]
-                time_elapsed, result = opGraph.partialFit(data, epoch)
+                if pipeline is None:
+                    read_start = timeit.default_timer()
+                    data = trainData.get_next_batch()
+                    read_times.append(timeit.default_timer()-read_start)
+
+                    loop = data[-1]
+                    time_elapsed, result = opGraph.partialFit(data, epoch)
+                    if comm is not None:
+                        # the epoch ends with the shortest shard
+                        loop = comm.any(loop)
+                else:
+                    # the pipeline runs out at the end of the epoch
+                    try:
+                        time_elapsed, result = opGraph.partialFit(None, epoch)
+                    except tf.errors.OutOfRangeError:
+                        break
                 net_times.append(time_elapsed)
 
-                results.append(result)
+                epoch_metrics.add(result)
+
+                batches += 1
+                if args.checkpoint_steps > 0 and batches % args.checkpoint_steps == 0 and not loop:
+                    # the position right after this batch, only recorded
+                    # for these batches
+                    state = pipeline.pop_state() if pipeline is not None else trainData.get_state()
+                    if state is not None:
+                        saveProgress(opGraph, writer, g_Output_CheckpointPath, epoch_idx_filename, 
+                            epoch, batches, state)
+
+            if pipeline is not None:
+                # reads happen on the pipeline's threads. none at all when
+                # the epoch is replayed from the cache
+                read_times = pipeline.take_read_times() or [0.]
 
             timing_log.log("runtime time for epoch %3.f" % (timeit.default_timer()-start))
 
-            with open(epoch_idx_filename, 'w') as save:
-                save.write(str(epoch))
+            if comm is not None:
+                tf_parallel.average_variables(comm, opGraph)
 
-            epoch_result = results[0].joinValInfos(results)
+            opGraph.readMetrics(epoch_metrics)
+            if comm is not None:
+                # each worker only counted its own shard
+                tf_parallel.reduce_metrics(comm, epoch_metrics)
+            epoch_result = epoch_metrics.result()
 
-            # save network
-            opGraph.saver.save(opGraph.sess, g_Output_CheckpointPath)
+            # save network. the epoch index only goes out once the checkpoint
+            # it belongs to is written
+            if chief:
+                def writeEpochIndex(epoch=epoch):
+                    with open(epoch_idx_filename, 'w') as save:
+                        save.write(str(epoch))
+
+                saveCheckpoint(opGraph, writer, g_Output_CheckpointPath, after=writeEpochIndex)
 
             timing_log.log("num loops %d" % (len(net_times)))
             timing_log.log("avg network time %.3f, avg read time %.3f" % \
@@ -233,7 +474,7 @@ def trainModels(args):
                 (np.sum(net_times), np.sum(read_times)))
 
             # occasionally validate
-            if epoch % args.display_step == 0:
+            if chief and epoch % args.display_step == 0:
                 vi = validateLoop(opGraph, valData)
 
                 # save the model if the performance increses. this is the 'ratchet' mechanism
@@ -242,7 +483,11 @@ def trainModels(args):
                     timestr = time.strftime("%Y-%m-%d %H:%M")
                     print(timestr)
                     bestPerf = vi
-                    opGraph.saver.save(opGraph.sess, ratchetCheckpoint)
+                    if writer is None:
+                        opGraph.saver.save(opGraph.sess, ratchetCheckpoint)
+                if writer is not None:
+                    # the writer keeps the keep_best lowest validation costs
+                    saveCheckpoint(opGraph, writer, ratchetCheckpoint, cost=float(vi.cost))
 
                 valData.reset()
 
@@ -253,11 +498,26 @@ def trainModels(args):
 
             valData.reset()
             trainData.reset()
-            trainData.randomize()
+            if comm is not None:
+                # a new order every epoch, the same in every worker
+                trainData.randomize((comm.seed + epoch + 1) % (2**31 - 1))
+            else:
+                trainData.randomize()
 
+            if args.checkpoint_steps > 0:
+                # the next epoch starts from here, with the order just drawn
+                saveProgress(opGraph, writer, g_Output_CheckpointPath, epoch_idx_filename, 
+                    epoch+1, 0, trainData.get_state())
 
         print("Optimization Finished!")
 
+        if writer is not None:
+            # the last checkpoints are still being written
+            writer.stop()
+
+        if args.batch_workers > 0:
+            trainData.stop()
+
 def validateModel(args):
     g_Output_CheckpointPath = os.path.join(args.outputFolder, args.out_check_name)
 
@@ -268,7 +528,7 @@ def validateModel(args):
     set_cuda_visible_devices(args)
     with tf.Graph().as_default():
         # restore saved weights if available
-        if os.path.exists(g_Output_CheckpointPath+'.index'):
+        if tf_checkpoint.resolve(g_Output_CheckpointPath) is not None:
             print("Found checkpoint", g_Output_CheckpointPath)
             checkpoint = g_Output_CheckpointPath
         else:
@@ -330,11 +590,12 @@ def dumpWeights(args):
 
     valData = buildValDatasets(args)
     print("there are", valData.numFeatures, "features")
+    saveFeatureColumns(args)
 
     set_cuda_visible_devices(args)
     with tf.Graph().as_default():
         # restore saved weights if available
-        if os.path.exists(g_Output_CheckpointPath+'.index'):
+        if tf_checkpoint.resolve(g_Output_CheckpointPath) is not None:
             print("Found checkpoint", g_Output_CheckpointPath)
             checkpoint = g_Output_CheckpointPath
         else:
@@ -377,6 +638,8 @@ if __name__ == "__main__":
         tf_encode.encodeFeatures(args)
     elif args.trainx[0] == '':
         validateModel(args)
+    elif args.num_workers > 1:
+        tf_parallel.run(args, trainModels)
     else:
         trainModels(args)
 
@@ -0,0 +1,259 @@
+# synchronous data parallel training on one node. run() forks a process per
+# worker, every one training its own copy of the network on a shard of the
+# chunks. the gradients of each step are averaged through shared memory
+# inside the graph (Network.minimize), so the copies take the same steps.
+#
+# the shared memory is a file in /dev/shm with a row per worker and a row for
+# the result. every worker writes its gradients to its row, sums its part of
+# the columns over all rows into the result row, and reads the whole result
+# back, with a barrier between the steps.
+from __future__ import division, print_function, absolute_import
+
+import os
+import time
+import tempfile
+import multiprocessing
+
+import numpy as np
+import tensorflow as tf
+
+# multiprocessing.Barrier only exists on python 3
+class ProcessBarrier(object):
+    def __init__(self, parties, context):
+        self.parties = parties
+        self.count = context.Value('i', 0, lock=False)
+        self.generation = context.Value('i', 0, lock=False)
+        self.condition = context.Condition()
+
+    def wait(self):
+        with self.condition:
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.parties:
+                self.count.value = 0
+                self.generation.value += 1
+                self.condition.notify_all()
+            else:
+                while generation == self.generation.value:
+                    self.condition.wait()
+
+class SharedAllreduce(object):
+    # made before forking, rank is set in every worker
+    def __init__(self, size, context):
+        self.size = size
+        self.rank = None
+        self.barrier = ProcessBarrier(size, context)
+
+        # the same in every worker, for what all of them have to shuffle alike
+        self.seed = np.random.randint(2**31 - 1)
+
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = os.path.join(shm, 'tf_parallel.%d' % os.getpid())
+        self.buffer = None
+        self.capacity = 0
+
+    # maps the shared memory, room for capacity float32 values per worker.
+    # every worker has to call it, with the same capacity
+    def attach(self, capacity):
+        shape = (self.size+1, max(capacity, 1))
+        if self.rank == 0:
+            self.buffer = np.memmap(self.path, dtype=np.float32, mode='w+', shape=shape)
+        self.barrier.wait()
+        if self.rank != 0:
+            self.buffer = np.memmap(self.path, dtype=np.float32, mode='r+', shape=shape)
+        self.barrier.wait()
+
+        # the mapping outlives the file
+        if self.rank == 0:
+            os.remove(self.path)
+        self.capacity = shape[1]
+
+    def unpack(self, row, arrays):
+        result = []
+        offset = 0
+        for a in arrays:
+            result.append(row[offset:offset+a.size].reshape(a.shape).astype(a.dtype))
+            offset += a.size
+        return result
+
+    # the mean of arrays over the workers. every worker passes arrays of the
+    # same shapes, at most capacity values in all
+    def average(self, arrays):
+        return self.reduce(arrays, 1. / self.size)
+
+    # the sum of arrays over the workers, like average
+    def total(self, arrays):
+        return self.reduce(arrays, 1.)
+
+    # the arrays of every worker, stacked in rank order, like average
+    def gather(self, array):
+        array = np.asarray(array)
+        rows = np.zeros((self.size,) + array.shape, dtype=array.dtype)
+        rows[self.rank] = array
+        [rows] = self.total([rows])
+        return rows
+
+    def reduce(self, arrays, scale):
+        arrays = [np.asarray(a) for a in arrays]
+        total = sum(a.size for a in arrays)
+        if total > self.capacity:
+            raise ValueError("%d values don't fit the allreduce buffer of %d" % (total, self.capacity))
+
+        offset = 0
+        for a in arrays:
+            self.buffer[self.rank, offset:offset+a.size] = a.ravel()
+            offset += a.size
+        self.barrier.wait()
+
+        start = total * self.rank // self.size
+        stop = total * (self.rank+1) // self.size
+        self.buffer[self.size, start:stop] = \
+            self.buffer[:self.size, start:stop].sum(axis=0, dtype=np.float64) * scale
+        self.barrier.wait()
+
+        # the next call only writes the result row after everyone got here
+        return self.unpack(self.buffer[self.size], arrays)
+
+    # rank 0's arrays, in every worker
+    def broadcast(self, arrays):
+        arrays = [np.asarray(a) for a in arrays]
+
+        # everyone is done reading the result row of the last call
+        self.barrier.wait()
+        if self.rank == 0:
+            offset = 0
+            for a in arrays:
+                self.buffer[self.size, offset:offset+a.size] = a.ravel()
+                offset += a.size
+        self.barrier.wait()
+        return self.unpack(self.buffer[self.size], arrays)
+
+    # whether flag is set in any worker
+    def any(self, flag):
+        [mean] = self.average([np.array([1. if flag else 0.], dtype=np.float32)])
+        return mean[0] > 0
+
+    # groups of consecutive arrays that fit the buffer, for the calls above
+    def pieces(self, arrays):
+        group = []
+        total = 0
+        for i, a in enumerate(arrays):
+            if total + a.size > self.capacity and group:
+                yield group
+                group = []
+                total = 0
+            group.append(i)
+            total += a.size
+        if group:
+            yield group
+
+# the variables every worker keeps a copy of, except the optimizer's own,
+# which stay in step as long as the gradients do
+def replicated_variables(opGraph):
+    optimizer = set(opGraph.optimizer_variables)
+    return [v for v in opGraph.sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES) \
+                if v not in optimizer]
+
+# sets the variables of the workers to theirs, through fn, piece by piece
+def exchange_variables(comm, opGraph, variables, fn):
+    values = opGraph.sess.run(variables)
+    for group in comm.pieces(values):
+        result = fn([values[i] for i in group])
+        opGraph.loadValues([variables[i] for i in group], result)
+
+# maps the shared memory for opGraph and starts every worker from rank 0's weights
+def setup(comm, opGraph):
+    variables = replicated_variables(opGraph)
+    largest = max([int(np.prod(v.get_shape().as_list())) for v in variables] + [0])
+    comm.attach(max(opGraph.gradient_size, largest))
+    exchange_variables(comm, opGraph, variables, comm.broadcast)
+
+# averages the variables the gradients don't update, like the center loss
+# centers, which every worker moves with its own batches
+def average_variables(comm, opGraph):
+    trainable = set(opGraph.sess.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES))
+    variables = [v for v in replicated_variables(opGraph) if v not in trainable]
+    exchange_variables(comm, opGraph, variables, comm.average)
+
+# merges the EpochAccumulator of every worker's shard into acc, in every
+# worker, so the epoch metrics cover the whole training set. the shared memory
+# holds float32, which keeps counts exact up to 2**24
+def reduce_metrics(comm, acc):
+    center_loss = acc.center_loss if acc.center_loss is not None else 0.
+    batches, cost, center_loss, squared_error, elements = comm.total([np.array(
+        [acc.batches, acc.cost, center_loss, acc.squared_error, acc.elements], dtype=np.float64)])[0]
+    acc.batches = int(round(batches))
+    acc.cost = cost
+    if acc.center_loss is not None:
+        acc.center_loss = center_loss
+    acc.squared_error = squared_error
+    acc.elements = int(round(elements))
+
+    # every label seen by any worker, each worker's confusion matrix moved
+    # to their positions, summed
+    sizes = comm.gather(np.array([len(acc.labels)], dtype=np.float64))
+    if sizes.max() > 0:
+        local = np.full(int(sizes.max()), np.nan, dtype=np.float32)
+        for v, i in acc.labels.items():
+            local[i] = v
+        values = comm.gather(local).ravel()
+        values = np.unique(values[~np.isnan(values)])
+
+        positions = np.searchsorted(values, local[:len(acc.labels)])
+        confusion = np.zeros((len(values), len(values)))
+        confusion[np.ix_(positions, positions)] = acc.confusion
+        [confusion] = comm.total([confusion])
+        acc.labels = dict((v, i) for i, v in enumerate(values))
+        acc.confusion = np.round(confusion).astype(np.int64)
+
+    # the r2 moments, merged like EpochAccumulator.add_regression does
+    columns = 0 if acc.mean is None else len(acc.mean)
+    columns = int(comm.gather(np.array([columns], dtype=np.float64)).max())
+    if columns > 0:
+        count = float(acc.count)
+        mean = acc.mean if acc.count > 0 else np.zeros(columns)
+        m2 = acc.m2 if acc.count > 0 else np.zeros(columns)
+        residual = acc.residual if acc.count > 0 else np.zeros(columns)
+
+        [total, weighted] = comm.total([np.array([count]), count * mean])
+        total = total[0]
+        overall = weighted / max(total, 1.)
+        [m2, residual] = comm.total([m2 + count * (mean - overall)**2, residual])
+        acc.count = int(round(total))
+        acc.mean, acc.m2, acc.residual = overall, m2, residual
+
+def worker(train, args, comm, rank):
+    comm.rank = rank
+    train(args, comm)
+
+# runs train(args, comm) in args.num_workers forked processes and waits for
+# them. when one fails the others are stopped, they'd wait on it forever
+def run(args, train):
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing
+
+    comm = SharedAllreduce(args.num_workers, context)
+    processes = []
+    for rank in range(args.num_workers):
+        p = context.Process(target=worker, args=(train, args, comm, rank))
+        p.start()
+        processes.append(p)
+
+    try:
+        while any(p.is_alive() for p in processes):
+            if any(p.exitcode not in (None, 0) for p in processes):
+                break
+            time.sleep(1)
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        if os.path.exists(comm.path):
+            os.remove(comm.path)
+
+    failed = [rank for rank, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError("training workers %s failed" % failed)
@@ -0,0 +1,103 @@
+# tf.data input for the networks in tf_graph. batches still come from a
+# ChunkGroup, so chunk loading, shuffling and containers behave the same, but
+# they reach the graph through a dataset iterator instead of feed_dict. the
+# generator runs on TF's threads, map converts each batch to the graph's
+# dtypes in parallel and prefetch keeps batches queued inside the runtime.
+from __future__ import division, print_function, absolute_import
+
+import tensorflow as tf
+import timeit
+import collections
+
+class DatasetPipeline(object):
+    # group: ChunkGroup, KeyedChunkGroup or PrefetchChunkGroup
+    # map_threads: num_parallel_calls for map
+    # prefetch: batches buffered after map
+    # cache: file name to cache the first epoch in. later epochs replay it
+    #   in the same order without touching the group. '' disables caching
+    def __init__(self, group, map_threads=4, prefetch=2, cache=''):
+        self.group = group
+
+        # one element per batch: every feature set, then the labels. the
+        # generator hands batches over in the dtypes they are stored in, like
+        # float16 features or float64 one hot labels, and the parallel map
+        # converts them to the dtypes the graph takes
+        types = []
+        shapes = []
+        self.graph_types = []
+        for feat in group.features:
+            types.append(tf.as_dtype(feat.batch_dtype))
+            shapes.append(tf.TensorShape([None, feat.numFeatures]))
+            self.graph_types.append(tf.float32)
+
+        labels = group.labels
+        if labels is not None:
+            if getattr(labels, 'encoder', None) is None:
+                # regression values
+                types.append(tf.as_dtype(labels.current_set.batch_dtype))
+                shapes.append(tf.TensorShape([None]))
+                self.graph_types.append(tf.float32)
+            elif labels.int_labels:
+                types.append(tf.int32)
+                shapes.append(tf.TensorShape([None]))
+                self.graph_types.append(tf.int32)
+            else:
+                types.append(tf.float64)
+                shapes.append(tf.TensorShape([None, labels.numClasses]))
+                self.graph_types.append(tf.int32)
+
+        self.types = tuple(types)
+        self.shapes = tuple(shapes)
+
+        # time spent getting batches from the group, collected by the generator
+        self.read_times = []
+
+        # with state_steps the generator records the group state after every
+        # state_steps-th batch of the epoch, counting from state_offset when
+        # an epoch is resumed. the generator runs ahead of training,
+        # pop_state hands them out in the order the batches are trained on
+        self.state_steps = 0
+        self.state_offset = 0
+        self.states = collections.deque()
+
+        dataset = tf.data.Dataset.from_generator(self.batches, self.types, self.shapes)
+        dataset = dataset.map(self.parse, num_parallel_calls=map_threads)
+        if cache:
+            dataset = dataset.cache(cache)
+        dataset = dataset.prefetch(prefetch)
+
+        # initialized once per epoch, the generator ends with the epoch
+        self.iterator = dataset.make_initializable_iterator()
+        self.initializer = self.iterator.initializer
+        self.next_batch = self.iterator.get_next()
+
+    def batches(self):
+        # one epoch, up to and including the batch that ends it
+        loop = False
+        count, self.state_offset = self.state_offset, 0
+        self.states.clear()
+        while not loop:
+            start = timeit.default_timer()
+            data = self.group.get_next_batch()
+            self.read_times.append(timeit.default_timer()-start)
+
+            loop = data[-1]
+            count += 1
+            if self.state_steps > 0 and count % self.state_steps == 0 and not loop:
+                self.states.append(self.group.get_state())
+            yield tuple(data[:len(self.types)])
+
+    def parse(self, *batch):
+        return tuple(tf.cast(tensor, dtype) for tensor, dtype in zip(batch, self.graph_types))
+
+    # the group state after the oldest recorded batch not popped yet. None
+    # when the batches came from the cache
+    def pop_state(self):
+        if len(self.states) == 0:
+            return None
+        return self.states.popleft()
+
+    # read times since the last call
+    def take_read_times(self):
+        read_times, self.read_times = self.read_times, []
+        return read_times
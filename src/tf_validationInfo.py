@@ -165,6 +165,14 @@ class AEResults:
     def truth_pred(self):
         return np.zeros((1,1))
 
+# the scalars partialFit fetches when the reconstruction and class metrics are
+# kept in the graph, see Network.readMetrics
+class BatchCostResults:
+    def __init__(self, cost, center_loss=None):
+        self.cost = cost
+        if center_loss is not None:
+            self.center_loss = center_loss
+
 class ClassifierResults:
     def __init__(self, y, pred_y, cost):
         self.y = y
@@ -224,6 +232,176 @@ class ClassifierResults:
     def concatPredictions(self, other_val_info):
         self.pred_y = np.concatenate([self.pred_y, other_val_info.pred_y], axis=1)
 
+# running sums over the batch results of a training epoch, so the epoch
+# metrics don't need every batch's inputs and reconstructions. add() takes
+# the results object of one batch and keeps what its metrics need: the cost,
+# squared reconstruction errors, a confusion matrix over the class labels,
+# the moments for r2 and the center loss. result() gives the same metrics as
+# joinValInfos over all the batches, in O(classes^2) memory
+class EpochAccumulator:
+    def __init__(self):
+        self.batches = 0
+        self.cost = 0.
+        self.center_loss = None
+
+        # reconstruction
+        self.squared_error = 0.
+        self.elements = 0
+
+        # labels by confusion matrix index. rows are true labels, columns predictions
+        self.labels = {}
+        self.confusion = np.zeros((0, 0), dtype=np.int64)
+
+        # r2, per output column
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.residual = None
+
+    def add(self, vi):
+        self.batches += 1
+        self.cost += vi.cost
+
+        if hasattr(vi, 'center_loss'):
+            self.center_loss = (self.center_loss or 0.) + vi.center_loss
+
+        if hasattr(vi, 'pred_X'):
+            diff = np.asarray(vi.X, dtype=np.float64) - vi.pred_X
+            self.squared_error += np.sum(diff * diff)
+            self.elements += diff.size
+
+        if hasattr(vi, 'pred_y'):
+            # training results hold one prediction per sample
+            pred = np.asarray(vi.pred_y).reshape(len(vi.y), -1)[:, 0]
+            self.add_labels(np.asarray(vi.y).reshape(-1), pred)
+
+        if hasattr(vi, 'P'):
+            self.add_regression(np.asarray(vi.Y, dtype=np.float64), np.asarray(vi.P, dtype=np.float64))
+
+    def add_labels(self, y, pred):
+        values, index = np.unique(np.concatenate([y, pred]), return_inverse=True)
+        positions = self.label_positions(values)[index]
+        np.add.at(self.confusion, (positions[:len(y)], positions[len(y):]), 1)
+
+    # confusion matrix index of every label, growing the matrix for new ones
+    def label_positions(self, values):
+        for v in values:
+            if v not in self.labels:
+                self.labels[v] = len(self.labels)
+
+        size = len(self.labels)
+        if size > self.confusion.shape[0]:
+            grown = np.zeros((size, size), dtype=np.int64)
+            grown[:self.confusion.shape[0], :self.confusion.shape[1]] = self.confusion
+            self.confusion = grown
+
+        return np.array([self.labels[v] for v in values], dtype=np.int64)
+
+    # totals counted somewhere else, like in the graph. the confusion matrix
+    # is indexed by class id
+    def add_totals(self, squared_error, elements, confusion):
+        self.squared_error += squared_error
+        self.elements += elements
+
+        positions = self.label_positions(range(len(confusion)))
+        self.confusion[np.ix_(positions, positions)] += confusion
+
+    # merges the mean and the sum of squared deviations of this batch into the
+    # running ones (Chan et al.), which stays accurate over long epochs
+    def add_regression(self, Y, P):
+        Y = Y.reshape(len(Y), -1)
+        P = P.reshape(Y.shape)
+        n = Y.shape[0]
+        if n == 0:
+            return
+
+        mean = Y.mean(axis=0)
+        m2 = ((Y - mean)**2).sum(axis=0)
+        residual = ((Y - P)**2).sum(axis=0)
+        if self.count == 0:
+            self.mean, self.m2, self.residual = mean, m2, residual
+        else:
+            total = self.count + n
+            delta = mean - self.mean
+            self.mean = self.mean + delta * n / total
+            self.m2 = self.m2 + m2 + delta**2 * self.count * n / total
+            self.residual = self.residual + residual
+        self.count += n
+
+    def result(self):
+        return StreamingResults(self)
+
+# the epoch metrics of an EpochAccumulator, with the methods the logs and
+# training loop use on the joined results
+class StreamingResults:
+    def __init__(self, acc):
+        self.cost = acc.cost / max(acc.batches, 1)
+        if acc.center_loss is not None:
+            self.center_loss = acc.center_loss / max(acc.batches, 1)
+
+        self.elements = acc.elements
+        self.squared_error = acc.squared_error
+        self.confusion = acc.confusion
+
+        if acc.count > 0:
+            # like r2_score: a constant target scores 1 when predicted exactly
+            r2 = np.where(acc.m2 > 0, 1 - acc.residual / np.where(acc.m2 > 0, acc.m2, 1),
+                np.where(acc.residual == 0, 1., 0.))
+            self.rsquared = np.mean(r2)
+
+    def compare(self, other):
+        if self.cost < other.cost:
+            print("new best score", self.cost)
+            return 1
+        elif self.cost == other.cost:
+            return 0
+        else:
+            return -1
+
+    def recon_error(self):
+        # rmse
+        return math.sqrt(self.squared_error / max(self.elements, 1))
+
+    # per class precision, recall and f1 from the confusion matrix, zero
+    # where undefined, and the support of every class
+    def class_scores(self):
+        tp = np.diag(self.confusion).astype(np.float64)
+        support = self.confusion.sum(axis=1)
+        predicted = self.confusion.sum(axis=0)
+        precision = tp / np.maximum(predicted, 1)
+        recall = tp / np.maximum(support, 1)
+        f1 = 2 * precision * recall / np.where(precision + recall > 0, precision + recall, 1)
+        return precision, recall, f1, support
+
+    # averaged over the classes weighted by support, like average='weighted'
+    def weighted(self, scores):
+        _, _, _, support = self.class_scores()
+        return np.sum(scores * support) / max(np.sum(support), 1)
+
+    def accuracy_score(self):
+        return np.trace(self.confusion) / max(np.sum(self.confusion), 1)
+
+    def precision_score(self):
+        return self.weighted(self.class_scores()[0])
+
+    def recall_score(self):
+        return self.weighted(self.class_scores()[1])
+
+    def f1(self):
+        return self.weighted(self.class_scores()[2])
+
+    def printStatistics(self):
+        print("cost %.3f" % self.cost)
+        if self.elements > 0:
+            print("reconstruction err %.3f:" % self.recon_error())
+        if self.confusion.size > 0:
+            print("accuracy %.3f precision %.3f recall %.3f" % 
+                (self.accuracy_score(), self.precision_score(), self.recall_score()))
+        if hasattr(self, 'center_loss'):
+            print("center_loss %.3f" % self.center_loss)
+        if hasattr(self, 'rsquared'):
+            print("r2_score:", self.rsquared)
+
 def countClasses(labels):
     unique = set()
     for l in labels: